@@ -0,0 +1,23 @@
+# Dahua VTO Dz
+#
+# Protocol core shared by the Domoticz plugin and the standalone runner
+#
+from .protocol import (DHIP_HEADER, DHIP_MAGIC, DHIPFrameDecoder, EventReceived, InvalidFrame, LoggedIn, LoginFailed,
+                       MulticallRejected, PendingRequest, PendingRequests, ProtocolEvent, RequestTimedOut, Response,
+                       StreamResynced, Subscribed, SubscriptionRejected, UnhandledMessage, VTOProtocol, encode_message,
+                       hash_password)
+from .call import (CALL_ANSWERED, CALL_CALLING, CALL_CONNECTED, CALL_ENDED, CALL_IDLE, CALL_MISSED, CALL_RINGING,
+                   CALL_STARTED, CALL_TRANSITIONS, DOORBELL_CALLING, DOORBELL_CONNECTED, DOORBELL_RINGING,
+                   CallStateMachine)
+from .capture import (CAPTURE_MAGIC, CAPTURE_RECORD, DIRECTION_CONNECT, DIRECTION_DISCONNECT, DIRECTION_IN,
+                      DIRECTION_OUT, CaptureWriter, read_capture)
+from .journal import JOURNAL_HEADER, JOURNAL_INDEX_ENTRY, JOURNAL_MAGIC, JOURNAL_RECORD, EventJournal, JournalEvent
+from .keepalive import (AdaptiveKeepAlive, FixedKeepAlive, KEEP_ALIVE_POLICIES, KeepAlivePolicy, RTTEstimator,
+                        create_keep_alive_policy)
+from .metrics import LATENCY_BUCKETS, LatencyHistogram, Metrics
+from .profiler import CallbackProfiler, CallbackStats
+from .outbound import PRIORITY_DOOR, PRIORITY_KEEP_ALIVE, PRIORITY_METADATA, OutboundQueue, OutboundRequest
+from .reconnect import FAILURE_AUTH, FAILURE_NETWORK, Backoff, ReconnectPolicy
+from .snapshot import (SNAPSHOT_PATH, SnapshotClient, SnapshotError, SnapshotResult, SnapshotStore, SnapshotWorker,
+                       digest_response, parse_challenge)
+from .scheduler import Timer, TimerScheduler
@@ -0,0 +1,70 @@
+# Dahua VTO Dz
+#
+# Standalone runner, which monitors the events of one or more Dahua VTO doorbells from a single event loop and
+# writes them to stdout as JSON lines:
+#
+#   python -m dahua_vto -u admin -p secret 192.168.1.10 192.168.1.11:5000
+#
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+from .aio import VTOClient
+from .protocol import EventReceived
+
+
+def parse_endpoint(value: str, default_port: int):
+    host, _, port = value.rpartition(":")
+    if host and port.isdigit():
+        return host, int(port)
+    return value, default_port
+
+
+def print_event(client: VTOClient, event: EventReceived):
+    line = {
+        "time": time.time(),
+        "vto": client.name,
+        "code": event.code,
+        "action": event.action,
+        "index": event.index,
+        "data": event.data
+    }
+    print(json.dumps(line, separators=(",", ":")), flush=True)
+
+
+async def monitor(clients: list):
+    await asyncio.gather(*(client.run() for client in clients))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m dahua_vto",
+                                     description="Monitor the events of one or more Dahua VTO doorbells.")
+    parser.add_argument("endpoints", nargs="+", metavar="HOST[:PORT]")
+    parser.add_argument("-u", "--username", default="admin")
+    parser.add_argument("-p", "--password", default=os.environ.get("DAHUA_VTO_PASSWORD", ""),
+                        help="defaults to the DAHUA_VTO_PASSWORD environment variable")
+    parser.add_argument("--port", type=int, default=5000, help="port of endpoints without port")
+    parser.add_argument("-c", "--codes", default="All", help="comma separated list of event codes")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, stream=sys.stderr,
+                        format="%(asctime)s %(levelname)s %(message)s")
+
+    codes = [code.strip() for code in args.codes.split(",") if code.strip()]
+    clients = [VTOClient(host, port, args.username, args.password, codes, print_event)
+               for host, port in (parse_endpoint(endpoint, args.port) for endpoint in args.endpoints)]
+
+    try:
+        asyncio.run(monitor(clients))
+    except KeyboardInterrupt:
+        return 130
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,201 @@
+# Dahua VTO Dz
+#
+# asyncio transport for the protocol core; many clients can share a single event loop
+#
+from typing import Callable
+import asyncio
+import logging
+import time
+
+from .keepalive import KeepAlivePolicy, create_keep_alive_policy
+from .outbound import PRIORITY_KEEP_ALIVE
+from .protocol import (EventReceived, LoggedIn, LoginFailed, MulticallRejected, PendingRequest, RequestTimedOut,
+                       Response, SubscriptionRejected, VTOProtocol)
+from .reconnect import FAILURE_AUTH, FAILURE_NETWORK, ReconnectPolicy
+
+logger = logging.getLogger(__name__)
+
+
+class VTOClient(asyncio.Protocol):
+    expire_interval = 1
+
+    def __init__(self, host: str, port: int = 5000, username: str = "", password: str = "", codes=("All",),
+                 on_event: Callable = None, keep_alive_policy: KeepAlivePolicy = None):
+        self.host = host
+        self.port = port
+        self.codes = list(codes)
+        self.on_event = on_event
+        self.protocol = VTOProtocol(username, password)
+        self.transport = None
+        self.closed = None
+        self.stopping = False
+        self.reconnect_policy = ReconnectPolicy()
+        self.failure = FAILURE_NETWORK
+        self.keep_alive_policy = keep_alive_policy if keep_alive_policy is not None else create_keep_alive_policy()
+        self.keep_alive_handle = None
+        self.expire_handle = None
+        self.event_handlers = {
+            LoggedIn: self.handle_logged_in,
+            LoginFailed: self.handle_login_failed,
+            Response: self.handle_response,
+            RequestTimedOut: self.handle_request_timed_out,
+            EventReceived: self.handle_event_received,
+            SubscriptionRejected: self.handle_subscription_rejected,
+            MulticallRejected: self.handle_multicall_rejected,
+        }
+
+    @property
+    def name(self):
+        return f"{self.host}:{self.port}"
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while not self.stopping:
+            self.failure = FAILURE_NETWORK
+            try:
+                await loop.create_connection(lambda: self, self.host, self.port)
+                await self.closed
+            except OSError as e:
+                logger.warning("%s: Failed to connect, error: %s", self.name, e)
+
+            if not self.stopping:
+                delay = self.reconnect_policy.next_delay(self.failure, time.monotonic())
+                logger.info("%s: Reconnecting in %.1f seconds", self.name, delay)
+                await asyncio.sleep(delay)
+
+    def stop(self):
+        self.stopping = True
+        if self.transport is not None:
+            self.transport.close()
+
+    def connection_made(self, transport):
+        loop = asyncio.get_running_loop()
+        logger.info("%s: Connected", self.name)
+        self.transport = transport
+        self.closed = loop.create_future()
+        self.protocol.connection_made()
+        self.flush()
+        self.expire_handle = loop.call_later(self.expire_interval, self.expire)
+
+    def data_received(self, data):
+        self.keep_alive_policy.on_received(time.monotonic())
+        for event in self.protocol.receive_data(data):
+            self.handle_event(event)
+        self.flush()
+
+    def connection_lost(self, exc):
+        logger.info("%s: Disconnected", self.name)
+        self.protocol.connection_lost()
+        self.transport = None
+        for handle in (self.keep_alive_handle, self.expire_handle):
+            if handle is not None:
+                handle.cancel()
+        self.keep_alive_handle = None
+        self.expire_handle = None
+        if self.closed is not None and not self.closed.done():
+            self.closed.set_result(exc)
+
+    def flush(self):
+        data = self.protocol.data_to_send()
+        if data and self.transport is not None:
+            self.keep_alive_policy.on_sent(time.monotonic())
+            self.transport.write(data)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    def expire(self):
+        for event in self.protocol.expire():
+            self.handle_event(event)
+        self.flush()
+        self.expire_handle = asyncio.get_running_loop().call_later(self.expire_interval, self.expire)
+
+    def handle_event(self, event):
+        handler = self.event_handlers.get(type(event))
+        if handler is not None:
+            handler(event)
+
+    def handle_logged_in(self, event: LoggedIn):
+        downtime = self.reconnect_policy.on_connected(time.monotonic())
+        if downtime:
+            logger.info("%s: Logged in after %.1f seconds disconnected (attempts: %s)", self.name, downtime,
+                        self.reconnect_policy.attempts)
+        else:
+            logger.info("%s: Logged in", self.name)
+        self.protocol.attach_events(self.codes)
+        if event.keep_alive_interval is not None:
+            self.keep_alive_policy.start(time.monotonic(), event.keep_alive_interval)
+            self.schedule_keep_alive()
+
+    def handle_login_failed(self, event: LoginFailed):
+        logger.error("%s: Failed to log in: %s", self.name, event.message)
+        self.failure = FAILURE_AUTH
+        self.close()
+
+    def handle_response(self, event: Response):
+        request = event.request
+        if request.single_response and request.sent_at is not None:
+            self.keep_alive_policy.on_response(time.monotonic() - request.sent_at)
+        request.handler(event.message)
+
+    def handle_request_timed_out(self, event: RequestTimedOut):
+        request = event.request
+        if request.on_timeout is not None:
+            request.on_timeout(request)
+        else:
+            logger.warning("%s: No response received for %s (id: %s)", self.name, request.method, request.request_id)
+
+    def handle_event_received(self, event: EventReceived):
+        if self.on_event is not None:
+            self.on_event(self, event)
+
+    def handle_subscription_rejected(self, event: SubscriptionRejected):
+        logger.warning("%s: Subscription to %s rejected: %s", self.name, event.codes, event.message)
+
+    def handle_multicall_rejected(self, event: MulticallRejected):
+        logger.warning("%s: system.multicall rejected: %s", self.name, event.message)
+
+    def schedule_keep_alive(self):
+        if self.keep_alive_handle is not None:
+            self.keep_alive_handle.cancel()
+        delay = max(self.keep_alive_policy.next_probe() - time.monotonic(), 0)
+        self.keep_alive_handle = asyncio.get_running_loop().call_later(delay, self.check_keep_alive)
+
+    def check_keep_alive(self):
+        self.keep_alive_handle = None
+        if self.keep_alive_policy.probing:
+            return
+        if self.keep_alive_policy.next_probe() > time.monotonic():
+            self.schedule_keep_alive()
+        else:
+            self.keep_alive()
+
+    def keep_alive(self):
+        request_data = {
+            "timeout": self.keep_alive_policy.interval,
+            "action": True
+        }
+
+        self.protocol.submit(PRIORITY_KEEP_ALIVE, "global.keepAlive", request_data, self.handle_keep_alive,
+                             timeout=self.keep_alive_policy.timeout(), on_timeout=self.handle_keep_alive_timeout)
+        self.flush()
+        self.keep_alive_policy.on_probe_sent(time.monotonic())
+
+    def handle_keep_alive(self, data):
+        if data.get("result"):
+            self.keep_alive_policy.on_probe_acked(time.monotonic())
+            self.schedule_keep_alive()
+        else:
+            logger.error("%s: Keep alive rejected: %s", self.name, data)
+            self.close()
+
+    def handle_keep_alive_timeout(self, request: PendingRequest):
+        if self.keep_alive_policy.on_probe_timeout(time.monotonic()):
+            logger.error("%s: No keep alive received", self.name)
+            self.close()
+        elif self.keep_alive_policy.failures == 0:
+            self.schedule_keep_alive()
+        else:
+            logger.warning("%s: No keep alive received; Resending keep alive", self.name)
+            self.keep_alive()
@@ -0,0 +1,60 @@
+# Dahua VTO Dz
+#
+# Prints the events in an event journal as JSON lines, e.g. all door openings and doorbell presses of the last day:
+#
+#   python -m dahua_vto.audit journal-192.168.1.10-5000.bin --since 24h --codes BackKeyLight,AccessControl
+#
+import argparse
+import json
+import re
+import sys
+import time
+
+from .journal import EventJournal
+
+
+def parse_time(value: str, now: float) -> float:
+    # Either a period before now, like 90s, 15m, 24h or 7d, or a date and time like 2024-01-31 or 2024-01-31T12:00
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([smhd]?)", value)
+    if match:
+        return now - float(match.group(1)) * {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400}[match.group(2)]
+    for time_format in ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return time.mktime(time.strptime(value, time_format))
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError(f"Invalid time: {value}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m dahua_vto.audit",
+                                     description="Print the events in an event journal as JSON lines.")
+    parser.add_argument("journal")
+    parser.add_argument("--since", help="start, e.g. 24h, 7d or 2024-01-31 12:00")
+    parser.add_argument("--until", help="end, in the same format")
+    parser.add_argument("--codes", default="", help="comma separated event codes")
+    args = parser.parse_args(argv)
+
+    now = time.time()
+    try:
+        start = parse_time(args.since, now) if args.since else None
+        end = parse_time(args.until, now) if args.until else None
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+    codes = [code.strip() for code in args.codes.split(",") if code.strip()]
+
+    try:
+        journal = EventJournal(args.journal, create=False)
+    except (OSError, ValueError) as e:
+        print(f"Failed to open event journal {args.journal}: {e}", file=sys.stderr)
+        return 1
+    try:
+        for event in journal.query(start, end, codes):
+            print(json.dumps(event.as_dict(), separators=(",", ":")))
+    finally:
+        journal.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,181 @@
+# Dahua VTO Dz
+#
+# Benchmarks of the receive and send paths, fed with the data of a capture:
+#
+#   python -m dahua_vto.bench capture.bin
+#
+# framing       splitting the received data into frames (DHIPFrameDecoder.feed without JSON)
+# decode        decoding a frame payload into a message (DHIPFrameDecoder.decode_payload)
+# event_stream  turning client.notifyEventStream messages into events (VTOProtocol.handle_event_stream)
+# encode        encoding the sent messages into frames (encode_message, as written by VTOProtocol.batch)
+# replay        the whole plugin, from Domoticz onMessage up to the device updates
+#
+# CPython has no cheap allocation counter, so the memory allocated per event is reported as the peak of the memory
+# traced by tracemalloc while handling it, in a separate run.
+#
+from typing import Callable
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+
+from .capture import DIRECTION_IN, DIRECTION_OUT
+from .protocol import DHIPFrameDecoder, VTOProtocol, encode_message
+from .replay import PayloadDecoder, Replay, count_frames, load_records
+
+
+def inbound_chunks(records: list) -> list:
+    return [data for direction, data in records if direction == DIRECTION_IN]
+
+
+def outbound_chunks(records: list) -> list:
+    return [data for direction, data in records if direction == DIRECTION_OUT]
+
+
+def measure(run: Callable, items: list, repeat: int) -> float:
+    # Returns the best time of a run over all items
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run(items)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def peak_bytes(handle: Callable, items: list) -> float:
+    # Average of the peak memory allocated while handling a single item
+    total = 0
+    tracemalloc.start()
+    try:
+        for item in items:
+            tracemalloc.reset_peak()
+            current, _ = tracemalloc.get_traced_memory()
+            handle(item)
+            _, peak = tracemalloc.get_traced_memory()
+            total += peak - current
+    finally:
+        tracemalloc.stop()
+    return total / len(items) if items else 0.0
+
+
+def bench_framing(records: list, repeat: int) -> dict:
+    chunks = inbound_chunks(records)
+
+    def run(items):
+        decoder = PayloadDecoder(1 << 24)
+        for chunk in items:
+            decoder.feed(chunk)
+
+    frames = len(PayloadDecoder(1 << 24).feed(b"".join(chunks)))
+    size = sum(len(chunk) for chunk in chunks)
+    elapsed = measure(run, chunks, repeat)
+    decoder = PayloadDecoder(1 << 24)
+    return {
+        "frames": frames,
+        "frames_per_second": round(frames / elapsed) if elapsed else None,
+        "megabytes_per_second": round(size / elapsed / 1e6, 1) if elapsed else None,
+        "peak_bytes_per_frame": round(peak_bytes(decoder.feed, chunks) * len(chunks) / frames) if frames else None,
+    }
+
+
+def bench_decode(records: list, repeat: int) -> dict:
+    payloads = [memoryview(payload) for payload in PayloadDecoder(1 << 24).feed(b"".join(inbound_chunks(records)))]
+    decoder = DHIPFrameDecoder()
+
+    def run(items):
+        decode_payload = decoder.decode_payload
+        for payload in items:
+            decode_payload(payload)
+
+    elapsed = measure(run, payloads, repeat)
+    return {
+        "frames": len(payloads),
+        "frames_per_second": round(len(payloads) / elapsed) if elapsed else None,
+        "peak_bytes_per_frame": round(peak_bytes(decoder.decode_payload, payloads)),
+    }
+
+
+def bench_event_stream(records: list, repeat: int) -> dict:
+    messages = [message for message in DHIPFrameDecoder(1 << 24).feed(b"".join(inbound_chunks(records)))
+                if message.get("method") == "client.notifyEventStream"]
+    events = sum(len(message["params"]["eventList"]) for message in messages)
+    protocol = VTOProtocol()
+
+    def handle(message):
+        protocol.handle_event_stream(message)
+        protocol.take_events()
+
+    def run(items):
+        for message in items:
+            handle(message)
+
+    elapsed = measure(run, messages, repeat)
+    return {
+        "events": events,
+        "events_per_second": round(events / elapsed) if elapsed else None,
+        "peak_bytes_per_event": round(peak_bytes(handle, messages) * len(messages) / events) if events else None,
+    }
+
+
+def bench_encode(records: list, repeat: int) -> dict:
+    # The messages sent during the capture, encoded again
+    messages = list(DHIPFrameDecoder(1 << 24).feed(b"".join(outbound_chunks(records))))
+
+    def run(items):
+        for message in items:
+            encode_message(message)
+
+    elapsed = measure(run, messages, repeat)
+    return {
+        "frames": len(messages),
+        "frames_per_second": round(len(messages) / elapsed) if elapsed else None,
+        "peak_bytes_per_frame": round(peak_bytes(encode_message, messages)),
+    }
+
+
+def bench_replay(records: list, repeat: int, options: str) -> dict:
+    frames, events = count_frames(records)
+    replay = Replay(records, options)
+    best = None
+    for _ in range(repeat):
+        replay.start()
+        start = time.perf_counter()
+        replay.run()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    replay.start()
+    peak = peak_bytes(replay.handle, records) * len(records)
+    return {
+        "frames": frames,
+        "events": events,
+        "frames_per_second": round(frames / best) if best else None,
+        "events_per_second": round(events / best) if best else None,
+        "peak_bytes_per_event": round(peak / events) if events else None,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m dahua_vto.bench",
+                                     description="Benchmark the receive and send paths with the data of a capture.")
+    parser.add_argument("capture")
+    parser.add_argument("-n", "--repeat", type=int, default=5, help="runs per benchmark; the best run counts")
+    parser.add_argument("-o", "--options", default="", help="options of the captured plugin")
+    args = parser.parse_args(argv)
+
+    records = load_records(args.capture)
+    result = {
+        "framing": bench_framing(records, args.repeat),
+        "decode": bench_decode(records, args.repeat),
+        "event_stream": bench_event_stream(records, args.repeat),
+        "encode": bench_encode(records, args.repeat),
+        "replay": bench_replay(records, args.repeat, args.options),
+    }
+    print(json.dumps(result, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
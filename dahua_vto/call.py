@@ -0,0 +1,96 @@
+# Dahua VTO Dz
+#
+# State machine of a call at the door, fed with the State of BackKeyLight events. Repeated and out of order states are
+# ignored, except ringing while calling or connected: that press of the doorbell button starts a new call, after ending
+# the call the end of which was lost (by a reconnect or a dropped frame). Ringing, answering and hanging up are
+# timestamped to derive the ring to answer time and the call duration.
+#
+from typing import Callable
+import time
+
+# BackKeyLight states; any other state ends the call
+DOORBELL_RINGING = 1
+DOORBELL_CALLING = 2
+DOORBELL_CONNECTED = 5
+
+CALL_IDLE = "idle"
+CALL_RINGING = "ringing"
+CALL_CALLING = "calling"
+CALL_CONNECTED = "connected"
+
+CALL_STARTED = "started"
+CALL_ANSWERED = "answered"
+CALL_MISSED = "missed"
+CALL_ENDED = "ended"
+
+# (call state, doorbell state) -> (new call state, action); pairs without entry are ignored. None stands for any state
+# that ends the call.
+CALL_TRANSITIONS = {
+    (CALL_IDLE, DOORBELL_RINGING): (CALL_RINGING, CALL_STARTED),
+    (CALL_IDLE, DOORBELL_CALLING): (CALL_CALLING, CALL_STARTED),
+    # Answered while the plugin was not connected; there is no ring to answer time
+    (CALL_IDLE, DOORBELL_CONNECTED): (CALL_CONNECTED, None),
+    (CALL_RINGING, DOORBELL_CALLING): (CALL_CALLING, None),
+    (CALL_RINGING, DOORBELL_CONNECTED): (CALL_CONNECTED, CALL_ANSWERED),
+    (CALL_RINGING, None): (CALL_IDLE, CALL_MISSED),
+    (CALL_CALLING, DOORBELL_CONNECTED): (CALL_CONNECTED, CALL_ANSWERED),
+    (CALL_CALLING, None): (CALL_IDLE, CALL_MISSED),
+    (CALL_CONNECTED, None): (CALL_IDLE, CALL_ENDED),
+}
+
+
+class CallStateMachine:
+    def __init__(self, clock: Callable = time.monotonic):
+        self.clock = clock
+        self.state = CALL_IDLE
+        self.ring_started = None
+        self.answered = None
+        # Results of the last answered and ended call
+        self.ring_to_answer = None
+        self.duration = None
+        self.calls = 0
+        self.missed_calls = 0
+
+    def feed(self, doorbell_state) -> list:
+        # Returns the (call state, action) transitions; none when the doorbell state was ignored
+        if doorbell_state not in (DOORBELL_RINGING, DOORBELL_CALLING, DOORBELL_CONNECTED):
+            doorbell_state = None
+        transitions = []
+        if doorbell_state == DOORBELL_RINGING and self.state in (CALL_CALLING, CALL_CONNECTED):
+            transitions.append(self.transition(None))
+        transition = self.transition(doorbell_state)
+        if transition is not None:
+            transitions.append(transition)
+        return transitions
+
+    def transition(self, doorbell_state) -> tuple:
+        transition = CALL_TRANSITIONS.get((self.state, doorbell_state))
+        if transition is None:
+            return None
+
+        self.state, action = transition
+        now = self.clock()
+        if action == CALL_STARTED:
+            self.calls += 1
+            self.ring_started = now
+            self.answered = None
+        elif action == CALL_ANSWERED:
+            self.answered = now
+            self.ring_to_answer = now - self.ring_started
+        elif action == CALL_MISSED:
+            self.missed_calls += 1
+            self.ring_started = None
+        elif action == CALL_ENDED:
+            if self.answered is not None:
+                self.duration = now - self.answered
+            self.ring_started = None
+            self.answered = None
+        elif self.state == CALL_CONNECTED and self.ring_started is None:
+            self.answered = now
+        return self.state, action
+
+    def reset(self):
+        # The call is lost with the connection; the counters are kept
+        self.state = CALL_IDLE
+        self.ring_started = None
+        self.answered = None
@@ -0,0 +1,63 @@
+# Dahua VTO Dz
+#
+# Capture file with the raw data received from and sent to a VTO. The file starts with CAPTURE_MAGIC, followed by a
+# record per chunk of data: monotonic timestamp (double), direction (byte), length (uint32) and the data itself.
+# Connects and disconnects are recorded without data.
+#
+from typing import Callable
+import struct
+import time
+
+CAPTURE_MAGIC = b"DVTOCAP1"
+CAPTURE_RECORD = struct.Struct("<dBL")
+DIRECTION_IN = 0
+DIRECTION_OUT = 1
+DIRECTION_CONNECT = 2
+DIRECTION_DISCONNECT = 3
+
+
+class CaptureWriter:
+    def __init__(self, path: str, clock: Callable = time.monotonic, buffering: int = 65536):
+        self.path = path
+        self.clock = clock
+        self.file = open(path, "wb", buffering=buffering)
+        self.file.write(CAPTURE_MAGIC)
+        self.records = 0
+        self.size = len(CAPTURE_MAGIC)
+
+    def write(self, direction: int, data=b"", timestamp: float = None):
+        if self.file is None:
+            return
+
+        self.file.write(CAPTURE_RECORD.pack(self.clock() if timestamp is None else timestamp, direction, len(data)))
+        self.file.write(data)
+        self.records += 1
+        self.size += CAPTURE_RECORD.size + len(data)
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def read_capture(path: str):
+    # Yields (timestamp, direction, data) for every record; a truncated last record is ignored
+    with open(path, "rb") as file:
+        if file.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"Not a capture file: {path}")
+
+        while True:
+            header = file.read(CAPTURE_RECORD.size)
+            if len(header) < CAPTURE_RECORD.size:
+                return
+
+            timestamp, direction, length = CAPTURE_RECORD.unpack(header)
+            data = file.read(length)
+            if len(data) < length:
+                return
+
+            yield timestamp, direction, data
@@ -0,0 +1,134 @@
+# Dahua VTO Dz
+#
+# Stand-in for the Domoticz module, so the plugin can run outside Domoticz for replays and benchmarks:
+#
+#   from dahua_vto import fake_domoticz
+#   fake_domoticz.install()
+#   import plugin
+#
+import sys
+
+Parameters = {
+    "Address": "127.0.0.1",
+    "Port": "5000",
+    "Username": "admin",
+    "Password": "",
+    "Mode1": "",
+    "Mode2": "",
+    "Mode6": "Normal",
+    "HomeFolder": "",
+}
+Settings = {}
+Images = {}
+Devices = {}
+
+# Log lines are only printed when verbose; they are always counted
+verbose = False
+log_lines = 0
+device_updates = 0
+debugging = 0
+heartbeat = None
+
+
+def _log(level: str, message):
+    global log_lines
+    log_lines += 1
+    if verbose:
+        print(f"{level}: {message}", file=sys.stderr)
+
+
+def Log(message):
+    _log("Log", message)
+
+
+def Status(message):
+    _log("Status", message)
+
+
+def Error(message):
+    _log("Error", message)
+
+
+def Debug(message):
+    if debugging:
+        _log("Debug", message)
+
+
+def Debugging(value):
+    global debugging
+    debugging = value
+
+
+def Heartbeat(interval):
+    global heartbeat
+    heartbeat = interval
+
+
+class Device:
+    def __init__(self, Name="", Unit=0, TypeName="", Type=0, Subtype=0, Switchtype=0, Image=0, Options=None,
+                 Used=0, DeviceID="", Description=""):
+        self.Name = Name
+        self.Unit = Unit
+        self.TypeName = TypeName
+        self.Switchtype = Switchtype
+        self.Image = Image
+        self.Options = Options or {}
+        self.ID = Unit
+        self.nValue = 0
+        self.sValue = ""
+        self.TimedOut = 0
+        self.LastLevel = 0
+
+    def Create(self):
+        Devices[self.Unit] = self
+
+    def Update(self, nValue=0, sValue="", TimedOut=0, **kwargs):
+        global device_updates
+        device_updates += 1
+        self.nValue = nValue
+        self.sValue = sValue
+        self.TimedOut = TimedOut
+
+    def Delete(self):
+        Devices.pop(self.Unit, None)
+
+
+class Connection:
+    def __init__(self, Name="", Transport="", Protocol="", Address="", Port="", Baud=0):
+        self.Name = Name
+        self.Transport = Transport
+        self.Protocol = Protocol
+        self.Address = Address
+        self.Port = Port
+        self.connected = False
+        # Everything sent over the connection, until taken by the test or replay
+        self.sent = []
+
+    def Connect(self):
+        self.connected = True
+
+    def Connected(self):
+        return self.connected
+
+    def Connecting(self):
+        return False
+
+    def Send(self, Message, Delay=0):
+        self.sent.append(bytes(Message))
+
+    def Disconnect(self):
+        self.connected = False
+
+
+def reset():
+    global log_lines, device_updates, debugging, heartbeat
+    Devices.clear()
+    log_lines = 0
+    device_updates = 0
+    debugging = 0
+    heartbeat = None
+
+
+def install():
+    # The plugin imports Domoticz by name
+    sys.modules["Domoticz"] = sys.modules[__name__]
@@ -0,0 +1,401 @@
+# Dahua VTO Dz
+#
+# Fake VTO server for load and soak tests. It handles the login challenge, keep alives, the requests of the plugin
+# and the event subscription, and can be told to misbehave: event storms, fragmented or coalesced data, dropped keep
+# alives and dropped connections. Optionally it serves snapshots over HTTP with digest authentication.
+#
+#   python -m dahua_vto.fake_vto --port 5000 --password secret --event-rate 50 --chunking fragment --http-port 8080
+#
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+from .protocol import DHIPFrameDecoder, encode_message, hash_password
+from .snapshot import SnapshotError, digest_response, parse_challenge
+
+logger = logging.getLogger(__name__)
+
+CHUNKING_MODES = ("normal", "fragment", "coalesce")
+
+
+class FakeVTOStats:
+    __slots__ = ("connections", "logins", "failed_logins", "requests", "keep_alives", "dropped_keep_alives",
+                 "events", "frames_sent", "bytes_sent", "bytes_received", "disconnects", "http_requests",
+                 "snapshots")
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+
+    def as_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class FakeVTO:
+    def __init__(self, username: str = "admin", password: str = "", keep_alive_interval: int = 60, doors: int = 1,
+                 event_rate: float = 0, events_per_frame: int = 1, chunking: str = "normal",
+                 drop_keep_alive: float = 0, disconnect_after: float = None, seed: int = None):
+        self.username = username
+        self.password = password
+        self.keep_alive_interval = keep_alive_interval
+        self.doors = doors
+        # Events per second sent to every subscribed session, in frames of events_per_frame events
+        self.event_rate = event_rate
+        self.events_per_frame = events_per_frame
+        self.chunking = chunking
+        # Chance that a keep alive is not answered
+        self.drop_keep_alive = drop_keep_alive
+        # Seconds after login after which the server drops the connection
+        self.disconnect_after = disconnect_after
+        self.random = random.Random(seed)
+        self.stats = FakeVTOStats()
+        self.sessions = set()
+        self.servers = []
+        self.http_server = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 5000) -> int:
+        # Can be started on more ports; returns the port it listens on
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(lambda: FakeVTOSession(self), host, port)
+        self.servers.append(server)
+        return server.sockets[0].getsockname()[1]
+
+    def start_http(self, host: str = "127.0.0.1", port: int = 80) -> int:
+        # Serves snapshots from a thread of its own; returns the port it listens on
+        self.http_server = FakeSnapshotServer(self, (host, port))
+        threading.Thread(target=self.http_server.serve_forever, name="fake-vto-http", daemon=True).start()
+        return self.http_server.server_address[1]
+
+    def close(self):
+        if self.http_server is not None:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+        for server in self.servers:
+            server.close()
+        for session in list(self.sessions):
+            session.close()
+
+
+class FakeVTOSession(asyncio.Protocol):
+    coalesce_interval = 0.05
+
+    def __init__(self, vto: FakeVTO):
+        self.vto = vto
+        self.stats = vto.stats
+        self.decoder = DHIPFrameDecoder()
+        self.transport = None
+        self.session_id = None
+        self.challenge = None
+        self.realm = None
+        # Replies to the calls of a system.multicall are collected, and sent as a single reply
+        self.replies = None
+        self.logged_in = False
+        self.event_request_id = None
+        self.pending_output = []
+        self.tasks = []
+        self.state = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.stats.connections += 1
+        self.vto.sessions.add(self)
+
+    def connection_lost(self, exc):
+        self.stats.disconnects += 1
+        self.vto.sessions.discard(self)
+        for task in self.tasks:
+            task.cancel()
+        self.transport = None
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    def data_received(self, data):
+        self.stats.bytes_received += len(data)
+        for message in self.decoder.feed(data):
+            self.handle_request(message)
+
+    def start_task(self, coroutine):
+        self.tasks.append(asyncio.get_running_loop().create_task(coroutine))
+
+    def send(self, message: dict):
+        if self.replies is not None:
+            self.replies.append(message)
+            return
+        if self.transport is None:
+            return
+
+        data = encode_message(message)
+        self.stats.frames_sent += 1
+        self.stats.bytes_sent += len(data)
+        chunking = self.vto.chunking
+        if chunking == "fragment":
+            # Split the frame at random places, down to a single byte
+            position = 0
+            while position < len(data):
+                size = self.vto.random.randint(1, 64)
+                self.transport.write(data[position:position + size])
+                position += size
+        elif chunking == "coalesce":
+            if not self.pending_output:
+                asyncio.get_running_loop().call_later(self.coalesce_interval, self.flush)
+            self.pending_output.append(data)
+        else:
+            self.transport.write(data)
+
+    def flush(self):
+        if self.transport is not None and self.pending_output:
+            self.transport.write(b"".join(self.pending_output))
+        self.pending_output.clear()
+
+    def reply(self, request: dict, result=True, params=None, error=None):
+        message = {"id": request.get("id"), "session": self.session_id, "result": result}
+        if params is not None:
+            message["params"] = params
+        if error is not None:
+            message["error"] = error
+        self.send(message)
+
+    def handle_request(self, request: dict):
+        self.stats.requests += 1
+        method = request.get("method")
+
+        if method == "global.login":
+            self.handle_login(request)
+        elif not self.logged_in:
+            self.reply(request, False, error={"code": 287637505, "message": "Invalid session in request data!"})
+        elif method == "system.multicall":
+            self.replies = []
+            for call in request.get("params") or []:
+                self.handle_request(call)
+            replies, self.replies = self.replies, None
+            self.reply(request, True, replies)
+        else:
+            handler = getattr(self, "handle_" + method.replace(".", "_"), None)
+            if handler is None:
+                self.reply(request, False, error={"code": 268894210, "message": "Method not found!"})
+            else:
+                handler(request)
+
+    def handle_login(self, request: dict):
+        params = request.get("params") or {}
+        if not params.get("password"):
+            self.session_id = self.vto.random.randint(1, 0x7fffffff)
+            self.challenge = str(self.vto.random.randint(0, 1 << 30))
+            self.realm = "Login to FAKEVTO0000000"
+            self.send({"id": request.get("id"), "session": self.session_id, "result": False,
+                       "error": {"code": 268632079, "message": "Component error: login challenge!"},
+                       "params": {"random": self.challenge, "realm": self.realm, "encryption": "Default"}})
+            return
+
+        expected = hash_password(self.challenge, self.realm, self.vto.username, self.vto.password)
+        if params.get("userName") != self.vto.username or params.get("password") != expected:
+            self.stats.failed_logins += 1
+            self.reply(request, False, error={"code": 268632085, "message": "Component error: invalid password!"})
+            return
+
+        self.stats.logins += 1
+        self.logged_in = True
+        self.reply(request, True, {"keepAliveInterval": self.vto.keep_alive_interval})
+        if self.vto.disconnect_after is not None:
+            asyncio.get_running_loop().call_later(self.vto.disconnect_after, self.close)
+
+    def handle_global_keepAlive(self, request: dict):
+        self.stats.keep_alives += 1
+        if self.vto.random.random() < self.vto.drop_keep_alive:
+            self.stats.dropped_keep_alives += 1
+            return
+        self.reply(request, True, {"timeout": self.vto.keep_alive_interval})
+
+    def handle_magicBox_getDeviceType(self, request: dict):
+        self.reply(request, True, {"type": "VTO2202F-P"})
+
+    def handle_magicBox_getSoftwareVersion(self, request: dict):
+        self.reply(request, True, {"version": {"Version": "4.500.0000000.5.R", "BuildDate": "2023-01-01"}})
+
+    def handle_configManager_getConfig(self, request: dict):
+        name = (request.get("params") or {}).get("name")
+        if name == "T2UServer":
+            self.reply(request, True, {"table": {"Enable": True, "UUID": "FAKEVTO0000000"}})
+        elif name == "AccessControl":
+            table = [{"AccessProtocol": "Local" if index == 0 else "Remote", "UnlockHoldInterval": 2,
+                      "UnlockReloadInterval": 5, "Name": f"Door{index + 1}"} for index in range(self.vto.doors)]
+            self.reply(request, True, {"table": table})
+        else:
+            self.reply(request, False, error={"code": 268959743, "message": "Unknown error!"})
+
+    def handle_accessControl_factory_instance(self, request: dict):
+        self.reply(request, 1001)
+
+    def handle_accessControl_openDoor(self, request: dict):
+        self.reply(request, True)
+        door_index = (request.get("params") or {}).get("DoorIndex", 0)
+        asyncio.get_running_loop().call_later(0.2, self.send_events, [self.access_control_event(door_index)])
+
+    def handle_accessControl_closeDoor(self, request: dict):
+        self.reply(request, True)
+
+    def handle_eventManager_attach(self, request: dict):
+        self.event_request_id = request.get("id")
+        self.reply(request, True)
+        if self.vto.event_rate > 0:
+            self.start_task(self.event_storm())
+
+    def send_events(self, events: list):
+        if self.event_request_id is None:
+            return
+        self.stats.events += len(events)
+        self.send({"id": self.event_request_id, "method": "client.notifyEventStream",
+                   "params": {"SID": 513, "eventList": events}, "session": self.session_id})
+
+    def access_control_event(self, door_index: int) -> dict:
+        return {"Code": "AccessControl", "Action": "Pulse", "Index": door_index,
+                "Data": {"Name": "OpenDoor", "Method": 4, "UserID": "", "LocaleTime": self.locale_time(),
+                         "UTC": int(time.time())}}
+
+    def doorbell_event(self) -> dict:
+        # Cycles through pressed, answered, hung up and idle, like a call at the door would
+        self.state = (self.state + 1) % 4
+        return {"Code": "BackKeyLight", "Action": "Pulse", "Index": 0,
+                "Data": {"State": (1, 2, 5, 0)[self.state], "LocaleTime": self.locale_time(), "UTC": int(time.time())}}
+
+    @staticmethod
+    def locale_time() -> str:
+        return time.strftime("%Y-%m-%d %H:%M:%S")
+
+    async def event_storm(self):
+        interval = self.vto.events_per_frame / self.vto.event_rate
+        deadline = asyncio.get_running_loop().time()
+        while self.transport is not None:
+            self.send_events([self.doorbell_event() for _ in range(self.vto.events_per_frame)])
+            deadline += interval
+            await asyncio.sleep(max(deadline - asyncio.get_running_loop().time(), 0))
+
+
+class FakeSnapshotServer(ThreadingHTTPServer):
+    daemon_threads = True
+    realm = "Login to FAKEVTO0000000"
+
+    def __init__(self, vto: FakeVTO, address: tuple):
+        super().__init__(address, SnapshotRequestHandler)
+        self.vto = vto
+        self.nonces = set()
+        self.lock = threading.Lock()
+
+    def new_nonce(self) -> str:
+        nonce = os.urandom(16).hex()
+        with self.lock:
+            self.nonces.add(nonce)
+        return nonce
+
+    def authorized(self, header: str, method: str) -> bool:
+        try:
+            credentials = parse_challenge(header)
+        except SnapshotError:
+            return False
+        with self.lock:
+            if credentials.get("nonce") not in self.nonces:
+                return False
+        if credentials.get("username") != self.vto.username:
+            return False
+        challenge = {"realm": self.realm, "nonce": credentials["nonce"]}
+        if "qop" in credentials:
+            challenge["qop"] = "auth"
+        expected = digest_response(challenge, self.vto.username, self.vto.password, method, credentials.get("uri", ""),
+                                   credentials.get("nc", ""), credentials.get("cnonce", ""))
+        return credentials.get("response") == expected
+
+
+class SnapshotRequestHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps the connection open between requests
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        stats = server.vto.stats
+        stats.http_requests += 1
+        if not self.path.startswith("/cgi-bin/snapshot.cgi"):
+            self.send_body(404, b"", "text/plain")
+            return
+
+        header = self.headers.get("Authorization")
+        if header is None or not server.authorized(header, "GET"):
+            self.send_response(401)
+            self.send_header("WWW-Authenticate", f'Digest realm="{server.realm}", qop="auth", '
+                                                 f'nonce="{server.new_nonce()}", opaque="{os.urandom(8).hex()}"')
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        stats.snapshots += 1
+        # Start and end of image markers around some noise; enough for the client, which does not decode it
+        self.send_body(200, b"\xff\xd8" + os.urandom(server.vto.random.randint(20000, 60000)) + b"\xff\xd9",
+                       "image/jpeg")
+
+    def send_body(self, status: int, body: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("%s %s", self.address_string(), format % args)
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("-u", "--username", default="admin")
+    parser.add_argument("-p", "--password", default="")
+    parser.add_argument("--keep-alive-interval", type=int, default=60)
+    parser.add_argument("--doors", type=int, default=1)
+    parser.add_argument("--event-rate", type=float, default=0, help="events per second per session")
+    parser.add_argument("--events-per-frame", type=int, default=1)
+    parser.add_argument("--chunking", choices=CHUNKING_MODES, default="normal")
+    parser.add_argument("--drop-keep-alive", type=float, default=0, help="chance that a keep alive is not answered")
+    parser.add_argument("--disconnect-after", type=float, help="drop connections this many seconds after login")
+    parser.add_argument("--seed", type=int)
+
+
+def create_fake_vto(args) -> FakeVTO:
+    return FakeVTO(args.username, args.password, args.keep_alive_interval, args.doors, args.event_rate,
+                   args.events_per_frame, args.chunking, args.drop_keep_alive, args.disconnect_after, args.seed)
+
+
+async def serve(vto: FakeVTO, host: str, port: int, http_port: int, report_interval: float):
+    port = await vto.start(host, port)
+    logger.info("Fake VTO listening on %s:%s", host, port)
+    if http_port is not None:
+        http_port = vto.start_http(host, http_port)
+        logger.info("Fake VTO serving snapshots on http://%s:%s", host, http_port)
+    while True:
+        await asyncio.sleep(report_interval)
+        print(json.dumps(vto.stats.as_dict(), separators=(",", ":")), flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m dahua_vto.fake_vto", description="Run a fake Dahua VTO.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--http-port", type=int, help="serve snapshots over HTTP on this port")
+    parser.add_argument("--report-interval", type=float, default=10)
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr, format="%(asctime)s %(levelname)s %(message)s")
+    try:
+        asyncio.run(serve(create_fake_vto(args), args.host, args.port, args.http_port, args.report_interval))
+    except KeyboardInterrupt:
+        return 130
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
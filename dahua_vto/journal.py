@@ -0,0 +1,217 @@
+# Dahua VTO Dz
+#
+# Append-only journal of received events in a memory mapped file of fixed size. The file holds a header, a ring of
+# sparse index entries (time and position of every index_interval bytes of records) and a ring of records; when the
+# records ring is full the oldest records are overwritten. Queries for a time range start at the index entry before
+# the range instead of at the oldest record. See dahua_vto.audit to query a journal from the command line.
+#
+# Positions are logical offsets that only increase; the offset in the records ring is the position modulo its size.
+#
+from typing import Callable
+from bisect import bisect_right
+import json
+import mmap
+import os
+import struct
+import time
+
+JOURNAL_MAGIC = b"DVTOJRN1"
+JOURNAL_VERSION = 1
+# Magic, version, records size, index slots, index interval, head, tail, index entries written, sequence
+JOURNAL_HEADER = struct.Struct("<8sLLLLQQQQ")
+JOURNAL_HEADER_SIZE = 64
+# Time, position
+JOURNAL_INDEX_ENTRY = struct.Struct("<dQ")
+# Length, sequence, time, index, code length, action length, payload length; followed by code, action and payload
+JOURNAL_RECORD = struct.Struct("<LQdlBBH")
+# A record length of 0 marks the rest of the ring as unused; the next record starts at the beginning
+JOURNAL_LENGTH = struct.Struct("<L")
+
+
+class JournalEvent:
+    __slots__ = ("sequence", "timestamp", "code", "action", "index", "payload")
+
+    def __init__(self, sequence: int, timestamp: float, code: str, action: str, index: int, payload: bytes):
+        self.sequence = sequence
+        self.timestamp = timestamp
+        self.code = code
+        self.action = action
+        self.index = index
+        self.payload = payload
+
+    @property
+    def data(self):
+        return json.loads(self.payload) if self.payload else None
+
+    def as_dict(self) -> dict:
+        return {"sequence": self.sequence, "time": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.timestamp)),
+                "timestamp": self.timestamp, "code": self.code, "action": self.action, "index": self.index,
+                "data": self.data}
+
+
+class EventJournal:
+    # Payloads that are larger are left out; the event itself is still journaled
+    max_payload = 4096
+
+    def __init__(self, path: str, size: int = 4 * 1024 * 1024, index_slots: int = 1024,
+                 clock: Callable = time.time, create: bool = True):
+        # The size and index slots only apply to a new journal; an existing journal keeps its own. Without create, a
+        # missing journal raises FileNotFoundError.
+        self.path = path
+        self.clock = clock
+        self.file = None
+        self.map = None
+        if create and not os.path.exists(path):
+            self.create(path, size, index_slots)
+
+        self.file = open(path, "r+b")
+        if os.fstat(self.file.fileno()).st_size < JOURNAL_HEADER_SIZE:
+            self.close()
+            raise ValueError(f"Not an event journal: {path}")
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        magic, version, self.size, self.index_slots, self.index_interval, self.head, self.tail, self.index_count, \
+            self.sequence = JOURNAL_HEADER.unpack_from(self.map, 0)
+        if magic != JOURNAL_MAGIC or version != JOURNAL_VERSION:
+            self.close()
+            raise ValueError(f"Not an event journal: {path}")
+        self.records_offset = JOURNAL_HEADER_SIZE + self.index_slots * JOURNAL_INDEX_ENTRY.size
+        if len(self.map) < self.records_offset + self.size:
+            self.close()
+            raise ValueError(f"Truncated event journal: {path}")
+        self.last_indexed = self.index_entry(self.index_count - 1)[1] if self.index_count else None
+
+    @staticmethod
+    def create(path: str, size: int, index_slots: int):
+        # Large enough that a record and the padding before it always fit
+        size = max(size, 65536)
+        index_interval = max(size // index_slots, JOURNAL_RECORD.size)
+        with open(path + ".tmp", "wb") as file:
+            file.truncate(JOURNAL_HEADER_SIZE + index_slots * JOURNAL_INDEX_ENTRY.size + size)
+            file.write(JOURNAL_HEADER.pack(JOURNAL_MAGIC, JOURNAL_VERSION, size, index_slots, index_interval, 0, 0, 0,
+                                           0))
+        os.replace(path + ".tmp", path)
+
+    def __len__(self):
+        return sum(1 for _ in self.positions(self.tail))
+
+    def write_header(self):
+        JOURNAL_HEADER.pack_into(self.map, 0, JOURNAL_MAGIC, JOURNAL_VERSION, self.size, self.index_slots,
+                                 self.index_interval, self.head, self.tail, self.index_count, self.sequence)
+
+    def index_entry(self, number: int) -> tuple:
+        slot = number % self.index_slots
+        return JOURNAL_INDEX_ENTRY.unpack_from(self.map, JOURNAL_HEADER_SIZE + slot * JOURNAL_INDEX_ENTRY.size)
+
+    def add_index_entry(self, timestamp: float, position: int):
+        slot = self.index_count % self.index_slots
+        JOURNAL_INDEX_ENTRY.pack_into(self.map, JOURNAL_HEADER_SIZE + slot * JOURNAL_INDEX_ENTRY.size, timestamp,
+                                      position)
+        self.index_count += 1
+        self.last_indexed = position
+
+    def next_position(self, position: int) -> int:
+        # Position of the record after the one at position
+        offset = position % self.size
+        remaining = self.size - offset
+        if remaining < JOURNAL_RECORD.size:
+            return position + remaining
+        length, = JOURNAL_LENGTH.unpack_from(self.map, self.records_offset + offset)
+        return position + (length or remaining)
+
+    def positions(self, position: int):
+        # Yields the positions of the records from position up to the head
+        while position < self.head:
+            offset = position % self.size
+            remaining = self.size - offset
+            if remaining < JOURNAL_RECORD.size:
+                position += remaining
+                continue
+            length, = JOURNAL_LENGTH.unpack_from(self.map, self.records_offset + offset)
+            if length == 0:
+                position += remaining
+                continue
+            yield position
+            position += length
+
+    def append(self, code: str, action: str, index: int = 0, data=None, timestamp: float = None) -> int:
+        # Returns the sequence number of the event
+        timestamp = self.clock() if timestamp is None else timestamp
+        code_bytes = str(code).encode("utf-8")[:255]
+        action_bytes = str(action).encode("utf-8")[:255]
+        payload = json.dumps(data, separators=(",", ":")).encode("utf-8") if data is not None else b""
+        if len(payload) > self.max_payload:
+            payload = b""
+        if not isinstance(index, int) or not -0x80000000 <= index <= 0x7fffffff:
+            index = 0
+        length = JOURNAL_RECORD.size + len(code_bytes) + len(action_bytes) + len(payload)
+
+        offset = self.head % self.size
+        remaining = self.size - offset
+        padding = remaining if remaining < length else 0
+        while self.head + padding + length - self.tail > self.size and self.tail < self.head:
+            # Overwrite the oldest records
+            self.tail = self.next_position(self.tail)
+        if padding:
+            if remaining >= JOURNAL_RECORD.size:
+                JOURNAL_LENGTH.pack_into(self.map, self.records_offset + offset, 0)
+            self.head += padding
+            offset = 0
+
+        position = self.records_offset + offset
+        JOURNAL_RECORD.pack_into(self.map, position, length, self.sequence, timestamp, index, len(code_bytes),
+                                 len(action_bytes), len(payload))
+        position += JOURNAL_RECORD.size
+        self.map[position:position + length - JOURNAL_RECORD.size] = code_bytes + action_bytes + payload
+
+        if self.last_indexed is None or self.head - self.last_indexed >= self.index_interval:
+            self.add_index_entry(timestamp, self.head)
+        self.head += length
+        self.sequence += 1
+        self.write_header()
+        return self.sequence - 1
+
+    def read(self, position: int) -> JournalEvent:
+        offset = self.records_offset + position % self.size
+        length, sequence, timestamp, index, code_length, action_length, payload_length = \
+            JOURNAL_RECORD.unpack_from(self.map, offset)
+        offset += JOURNAL_RECORD.size
+        code = str(self.map[offset:offset + code_length], "utf-8")
+        offset += code_length
+        action = str(self.map[offset:offset + action_length], "utf-8")
+        offset += action_length
+        return JournalEvent(sequence, timestamp, code, action, index, self.map[offset:offset + payload_length])
+
+    def start_position(self, start: float) -> int:
+        # Position of the last indexed record before start, which is still in the journal
+        first = max(self.index_count - self.index_slots, 0)
+        entries = [entry for entry in (self.index_entry(number) for number in range(first, self.index_count))
+                   if entry[1] >= self.tail]
+        found = bisect_right([timestamp for timestamp, _ in entries], start) - 1
+        return entries[found][1] if found >= 0 else self.tail
+
+    def query(self, start: float = None, end: float = None, codes=None):
+        # Yields the events from start up to and including end, optionally only those with the given codes. The
+        # records are in the order they were appended, so the time of the events is expected to only increase.
+        codes = set(codes) if codes else None
+        position = self.tail if start is None else self.start_position(start)
+        for position in self.positions(position):
+            event = self.read(position)
+            if end is not None and event.timestamp > end:
+                return
+            if start is not None and event.timestamp < start:
+                continue
+            if codes is None or event.code in codes:
+                yield event
+
+    def flush(self):
+        if self.map is not None:
+            self.map.flush()
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
@@ -0,0 +1,138 @@
+# Dahua VTO Dz
+#
+# Keep alive policies, which decide when a global.keepAlive probe is sent and how long to wait for its reply
+#
+
+
+class RTTEstimator:
+    # Smoothed round trip time and its variation, as used for TCP retransmission timeouts (RFC 6298)
+    __slots__ = ("srtt", "rttvar", "samples")
+
+    alpha = 1 / 8
+    beta = 1 / 4
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.samples = 0
+
+    def add(self, rtt: float):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.beta) * self.rttvar + self.beta * abs(self.srtt - rtt)
+            self.srtt = (1 - self.alpha) * self.srtt + self.alpha * rtt
+        self.samples += 1
+
+    def timeout(self, default: float) -> float:
+        if self.srtt is None:
+            return default
+        return self.srtt + 4 * self.rttvar
+
+
+class KeepAlivePolicy:
+    # Probes are sent this many seconds before the session of the VTO would expire
+    margin = 5
+    probe_timeout = 3
+    # Consecutive probes without any received data before the connection is considered dead; None never gives up
+    max_probe_failures = None
+
+    def __init__(self, idle_timeout: float = None):
+        self.idle_timeout = idle_timeout
+        self.session_timeout = None
+        self.last_received = None
+        self.last_sent = None
+        self.last_probe = None
+        self.probe_sent = None
+        self.failures = 0
+        self.rtt = RTTEstimator()
+
+    @property
+    def interval(self) -> float:
+        return max(self.session_timeout - self.margin, 1)
+
+    @property
+    def probing(self) -> bool:
+        return self.probe_sent is not None
+
+    def start(self, now: float, session_timeout: float):
+        self.session_timeout = session_timeout
+        self.last_received = now
+        self.last_sent = now
+        self.last_probe = now
+        self.probe_sent = None
+        self.failures = 0
+
+    def on_received(self, now: float):
+        self.last_received = now
+
+    def on_sent(self, now: float):
+        self.last_sent = now
+
+    def on_response(self, rtt: float):
+        self.rtt.add(rtt)
+
+    def on_probe_sent(self, now: float):
+        self.probe_sent = now
+        self.last_sent = now
+
+    def on_probe_acked(self, now: float):
+        self.probe_sent = None
+        self.last_probe = now
+        self.failures = 0
+
+    def on_probe_timeout(self, now: float) -> bool:
+        # Returns whether the connection should be given up
+        alive = self.last_received > self.probe_sent
+        self.probe_sent = None
+        if alive:
+            self.last_probe = now
+            self.failures = 0
+            return False
+
+        self.failures += 1
+        return self.max_probe_failures is not None and self.failures >= self.max_probe_failures
+
+    def next_probe(self) -> float:
+        return self.last_probe + self.interval
+
+    def timeout(self) -> float:
+        return self.probe_timeout
+
+
+class FixedKeepAlive(KeepAlivePolicy):
+    # A probe every keepAliveInterval - 5 seconds, which waits 3 seconds for its reply and is resent until it succeeds
+    pass
+
+
+class AdaptiveKeepAlive(KeepAlivePolicy):
+    # Any received data proves the VTO is alive, so a probe is only sent after idle_timeout seconds without received
+    # data, or when no request was sent for so long that the session would expire. The reply may take as long as
+    # the measured round trip times allow.
+    max_probe_failures = 3
+    # The timers of the plugin fire on heartbeats, so shorter timeouts would only be rounded up
+    min_timeout = 2
+    max_timeout = 30
+
+    def next_probe(self) -> float:
+        idle_timeout = self.interval if self.idle_timeout is None else min(self.idle_timeout, self.interval)
+        return min(self.last_received + idle_timeout, self.last_sent + self.interval)
+
+    def timeout(self) -> float:
+        # Every failed probe doubles the timeout of the next one
+        timeout = max(self.rtt.timeout(self.probe_timeout), self.min_timeout) * (2 ** self.failures)
+        return min(timeout, self.max_timeout)
+
+
+KEEP_ALIVE_POLICIES = {
+    "fixed": FixedKeepAlive,
+    "adaptive": AdaptiveKeepAlive,
+}
+
+
+def create_keep_alive_policy(name: str = "adaptive", idle_timeout: float = None) -> KeepAlivePolicy:
+    policy = KEEP_ALIVE_POLICIES.get(name)
+    if policy is None:
+        raise ValueError(f"Unknown keep alive policy: {name}")
+    return policy(idle_timeout)
@@ -0,0 +1,170 @@
+# Dahua VTO Dz
+#
+# Load and soak driver: runs the plugin, with the fake Domoticz module and real sockets, against the fake VTO server
+# and reports the state of both at a fixed interval as JSON lines:
+#
+#   python -m dahua_vto.load --duration 3600 --event-rate 20 --chunking fragment --drop-keep-alive 0.1
+#
+import argparse
+import asyncio
+import json
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from . import fake_domoticz
+from .fake_vto import add_arguments, create_fake_vto
+from .replay import load_plugin
+
+
+class SocketConnection(fake_domoticz.Connection):
+    # Domoticz connection backed by an asyncio socket; the plugin callbacks are called like Domoticz would
+    plugin = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.transport = None
+        self.connecting = False
+        self.loop = None
+
+    def Connect(self):
+        self.connecting = True
+        self.loop = asyncio.get_running_loop()
+        self.loop.create_task(self.open())
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.create_connection(lambda: SocketBridge(self), self.Address, int(self.Port))
+        except OSError as e:
+            self.connecting = False
+            self.plugin.onConnect(self, 1, str(e))
+
+    def Connecting(self):
+        return self.connecting
+
+    # Like Domoticz, sending and disconnecting are queued, so the worker thread of the plugin can use them too
+    def Send(self, Message, Delay=0):
+        self.loop.call_soon_threadsafe(self.write, Message)
+
+    def write(self, message: bytes):
+        if self.transport is not None:
+            self.transport.write(message)
+
+    def Disconnect(self):
+        self.loop.call_soon_threadsafe(self.close)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
+class SocketBridge(asyncio.Protocol):
+    def __init__(self, connection: SocketConnection):
+        self.connection = connection
+
+    def connection_made(self, transport):
+        connection = self.connection
+        connection.transport = transport
+        connection.connecting = False
+        connection.connected = True
+        connection.plugin.onConnect(connection, 0, "")
+
+    def data_received(self, data):
+        self.connection.plugin.onMessage(self.connection, data)
+
+    def connection_lost(self, exc):
+        connection = self.connection
+        connection.transport = None
+        connection.connected = False
+        connection.plugin.onDisconnect(connection)
+
+
+def plugin_report(plugin_module) -> dict:
+    endpoints = plugin_module._plugin.endpoints
+    return {
+        "device_updates": fake_domoticz.device_updates,
+        "reconnect_attempts": sum(endpoint.reconnect_policy.attempts for endpoint in endpoints),
+        "disconnected_seconds": round(sum(endpoint.reconnect_policy.time_disconnected(time.monotonic())
+                                          for endpoint in endpoints), 1),
+        "pending_requests": sum(len(endpoint.protocol.pending) for endpoint in endpoints),
+        "queued_requests": sum(len(endpoint.protocol.queue) for endpoint in endpoints),
+        "parse_failures": sum(endpoint.protocol.decoder.parse_failures for endpoint in endpoints),
+        "resyncs": sum(endpoint.protocol.decoder.resyncs for endpoint in endpoints),
+    }
+
+
+def memory_report(trace: bool) -> dict:
+    report = {"max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+    if trace:
+        current, peak = tracemalloc.get_traced_memory()
+        report["traced_kb"] = current // 1024
+        report["traced_peak_kb"] = peak // 1024
+    return report
+
+
+async def run(args, plugin_module):
+    vto = create_fake_vto(args)
+    # Every connection of the plugin needs an address of its own
+    ports = [await vto.start("127.0.0.1", 0) for _ in range(args.endpoints)]
+
+    options = args.options
+    home_folder = ""
+    if args.snapshots:
+        # Snapshots are served over HTTP and saved to a temporary folder
+        options = f"{options};snapshot;snapshot_port={vto.start_http('127.0.0.1', 0)}"
+        home_folder = tempfile.mkdtemp(prefix="dahua-vto-load-") + "/"
+
+    fake_domoticz.reset()
+    fake_domoticz.Parameters.update({"Address": ", ".join(f"127.0.0.1:{port}" for port in ports), "Port": "5000",
+                                     "Username": args.username, "Password": args.password, "Mode1": "",
+                                     "Mode2": options, "Mode6": "Normal", "HomeFolder": home_folder})
+    plugin_module.onStart()
+
+    start = time.monotonic()
+    next_report = start + args.report_interval
+    while time.monotonic() - start < args.duration:
+        await asyncio.sleep(fake_domoticz.heartbeat or 1)
+        plugin_module.onHeartbeat()
+
+        if time.monotonic() >= next_report:
+            next_report += args.report_interval
+            report = {"elapsed": round(time.monotonic() - start, 1), "vto": vto.stats.as_dict(),
+                      "plugin": plugin_report(plugin_module), "memory": memory_report(args.trace_memory)}
+            print(json.dumps(report, separators=(",", ":")), flush=True)
+
+    plugin_module.onStop()
+    vto.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m dahua_vto.load",
+                                     description="Run the plugin against a fake Dahua VTO for load and soak tests.")
+    parser.add_argument("--duration", type=float, default=60, help="seconds to run")
+    parser.add_argument("--report-interval", type=float, default=10)
+    parser.add_argument("--endpoints", type=int, default=1, help="number of connections from the plugin")
+    parser.add_argument("-o", "--options", default="metadata_cache=off", help="options of the plugin")
+    parser.add_argument("--snapshots", action="store_true", help="take snapshots over HTTP on every doorbell press")
+    parser.add_argument("--trace-memory", action="store_true", help="report the memory traced by tracemalloc")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print the log of the plugin")
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.trace_memory:
+        tracemalloc.start()
+    fake_domoticz.verbose = args.verbose
+    plugin_module = load_plugin()
+    SocketConnection.plugin = plugin_module
+    fake_domoticz.Connection = SocketConnection
+
+    try:
+        asyncio.run(run(args, plugin_module))
+    except KeyboardInterrupt:
+        return 130
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,141 @@
+# Dahua VTO Dz
+#
+# Metrics collected per report interval: round trip times per method, events per code and action, data and frames in
+# and out, parse failures, reconnects and the time from a doorbell event to the device update
+#
+from bisect import bisect_left
+
+# Upper bounds in seconds of the latency buckets; slower samples go into an extra last bucket
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class LatencyHistogram:
+    __slots__ = ("bounds", "buckets", "count", "total", "max")
+
+    def __init__(self, bounds: tuple = LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.buckets[bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, fraction: float) -> float:
+        # Upper bound of the bucket holding the percentile, but never more than the slowest sample
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(self.bounds[index], self.max) if index < len(self.bounds) else self.max
+        return self.max
+
+    def reset(self):
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def as_dict(self) -> dict:
+        return {"count": self.count, "mean": self.mean(), "p50": self.percentile(0.5), "p95": self.percentile(0.95),
+                "max": self.max}
+
+
+class Metrics:
+    def __init__(self):
+        self.rpc = {}
+        self.events = {}
+        self.doorbell_latency = LatencyHistogram()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames_in = 0
+        self.frames_out = 0
+        self.parse_failures = 0
+        self.reconnects = 0
+        # Totals of the protocol counters at the start of the interval
+        self.protocol_totals = (0, 0, 0)
+
+    def observe_rpc(self, method: str, seconds: float):
+        histogram = self.rpc.get(method)
+        if histogram is None:
+            histogram = self.rpc[method] = LatencyHistogram()
+        histogram.observe(seconds)
+
+    def count_event(self, code: str, action: str):
+        key = (code, action)
+        self.events[key] = self.events.get(key, 0) + 1
+
+    def collect_protocol(self, protocol):
+        # The protocol counts frames and parse failures since it was created; only the increase counts
+        totals = (protocol.decoder.frames, protocol.frames_sent, protocol.decoder.parse_failures)
+        self.frames_in += totals[0] - self.protocol_totals[0]
+        self.frames_out += totals[1] - self.protocol_totals[1]
+        self.parse_failures += totals[2] - self.protocol_totals[2]
+        self.protocol_totals = totals
+
+    def rpc_latency(self) -> LatencyHistogram:
+        histogram = LatencyHistogram()
+        for method_histogram in self.rpc.values():
+            histogram.buckets = [a + b for a, b in zip(histogram.buckets, method_histogram.buckets)]
+            histogram.count += method_histogram.count
+            histogram.total += method_histogram.total
+            histogram.max = max(histogram.max, method_histogram.max)
+        return histogram
+
+    def event_count(self) -> int:
+        return sum(self.events.values())
+
+    def summary(self) -> str:
+        parts = [f"Events: {self.event_count()}"]
+        if self.events:
+            counts = ", ".join(f"{code}/{action}: {count}" for (code, action), count in
+                               sorted(self.events.items(), key=lambda item: -item[1]))
+            parts[0] += f" ({counts})"
+        parts.append(f"In: {self.frames_in} frames, {self.bytes_in} bytes")
+        parts.append(f"Out: {self.frames_out} frames, {self.bytes_out} bytes")
+        parts.append(f"Parse failures: {self.parse_failures}")
+        parts.append(f"Reconnects: {self.reconnects}")
+        if self.doorbell_latency.count:
+            parts.append(f"Doorbell to update: {format_latency(self.doorbell_latency)}")
+        for method, histogram in sorted(self.rpc.items()):
+            parts.append(f"{method}: {format_latency(histogram)}")
+        return "; ".join(parts)
+
+    def reset(self):
+        # Starts a new interval; the protocol totals carry over
+        self.rpc = {}
+        self.events = {}
+        self.doorbell_latency.reset()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames_in = 0
+        self.frames_out = 0
+        self.parse_failures = 0
+        self.reconnects = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "rpc": {method: histogram.as_dict() for method, histogram in self.rpc.items()},
+            "events": {f"{code}/{action}": count for (code, action), count in self.events.items()},
+            "doorbell_latency": self.doorbell_latency.as_dict(),
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "frames_in": self.frames_in,
+            "frames_out": self.frames_out,
+            "parse_failures": self.parse_failures,
+            "reconnects": self.reconnects,
+        }
+
+
+def format_latency(histogram: LatencyHistogram) -> str:
+    return (f"{histogram.count}x, p50 {histogram.percentile(0.5) * 1000:.1f} ms, "
+            f"p95 {histogram.percentile(0.95) * 1000:.1f} ms, max {histogram.max * 1000:.1f} ms")
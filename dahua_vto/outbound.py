@@ -0,0 +1,58 @@
+# Dahua VTO Dz
+#
+# Outbound request queue; requests are sent by priority, with a limit on the requests awaiting a response
+#
+from typing import Callable
+import heapq
+
+PRIORITY_DOOR = 0
+PRIORITY_KEEP_ALIVE = 1
+PRIORITY_METADATA = 2
+
+
+class OutboundRequest:
+    __slots__ = ("priority", "method", "params", "handler", "single_response", "instance_id", "timeout",
+                 "on_timeout")
+
+    def __init__(self, priority: int, method: str, params, handler: Callable, single_response: bool = True,
+                 instance_id: int = None, timeout: float = None, on_timeout: Callable = None):
+        self.priority = priority
+        self.method = method
+        self.params = params
+        self.handler = handler
+        self.single_response = single_response
+        self.instance_id = instance_id
+        self.timeout = timeout
+        self.on_timeout = on_timeout
+
+
+class OutboundQueue:
+    # Door control skips the in-flight limit, so it never waits for slow metadata requests
+    unlimited_priority = PRIORITY_DOOR
+
+    def __init__(self, max_in_flight: int = 4):
+        self.max_in_flight = max_in_flight
+        # Heap of (priority, sequence, request); the sequence keeps requests of equal priority in order
+        self.requests = []
+        self.sequence = 0
+
+    def __len__(self):
+        return len(self.requests)
+
+    def put(self, request: OutboundRequest):
+        heapq.heappush(self.requests, (request.priority, self.sequence, request))
+        self.sequence += 1
+
+    def take(self, in_flight: int) -> list:
+        ready = []
+        while self.requests:
+            priority = self.requests[0][0]
+            if priority > self.unlimited_priority and in_flight >= self.max_in_flight:
+                break
+            ready.append(heapq.heappop(self.requests)[2])
+            if ready[-1].single_response:
+                in_flight += 1
+        return ready
+
+    def clear(self):
+        self.requests.clear()
@@ -0,0 +1,113 @@
+# Dahua VTO Dz
+#
+# Profiler for the plugin callbacks. Callbacks are run under cProfile; at a fixed interval the time spent per callback
+# and the top functions are written to profile.txt (and the raw stats to profile.prof, for pstats or snakeviz) in the
+# given folder, after the earlier files were rotated to profile.1.txt, profile.2.txt and so on.
+#
+from typing import Callable
+import cProfile
+import os
+import pstats
+import time
+
+
+class CallbackStats:
+    __slots__ = ("calls", "total", "max")
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, elapsed: float):
+        self.calls += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+
+class CallbackProfiler:
+    top = 30
+
+    def __init__(self, folder: str, interval: float = 300, keep: int = 5, clock: Callable = time.monotonic,
+                 on_error: Callable = None):
+        self.folder = folder
+        self.interval = interval
+        self.keep = keep
+        self.clock = clock
+        # Called with the OSError when the stats cannot be written; without it the error is raised
+        self.on_error = on_error
+        self.profile = cProfile.Profile()
+        self.callbacks = {}
+        self.started = clock()
+        self.next_write = self.started + interval
+
+    def wrap(self, name: str, callback: Callable) -> Callable:
+        def profiled(*args):
+            return self.call(name, callback, *args)
+        return profiled
+
+    def call(self, name: str, callback: Callable, *args):
+        start = time.perf_counter()
+        self.profile.enable()
+        try:
+            return callback(*args)
+        finally:
+            self.profile.disable()
+            stats = self.callbacks.get(name)
+            if stats is None:
+                stats = self.callbacks[name] = CallbackStats()
+            stats.add(time.perf_counter() - start)
+            if self.clock() >= self.next_write:
+                self.write()
+
+    def path(self, extension: str, generation: int = 0) -> str:
+        name = f"profile.{generation}.{extension}" if generation else f"profile.{extension}"
+        return os.path.join(self.folder, name)
+
+    def rotate(self):
+        for extension in ("txt", "prof"):
+            for generation in range(self.keep - 1, -1, -1):
+                path = self.path(extension, generation)
+                if not os.path.exists(path):
+                    continue
+                if generation + 1 >= self.keep:
+                    os.remove(path)
+                else:
+                    os.replace(path, self.path(extension, generation + 1))
+
+    def write(self) -> str:
+        # Writes the stats since the previous write and starts over
+        try:
+            return self.write_stats()
+        except OSError as e:
+            if self.on_error is None:
+                raise
+            self.on_error(e)
+            return None
+
+    def write_stats(self) -> str:
+        now = self.clock()
+        profile, callbacks, started = self.profile, self.callbacks, self.started
+        self.profile = cProfile.Profile()
+        self.callbacks = {}
+        self.started = now
+        self.next_write = now + self.interval
+
+        self.rotate()
+        path = self.path("txt")
+        with open(path, "w") as file:
+            file.write(f"Profile of {now - started:.0f} seconds, written {time.strftime('%Y-%m-%d %H:%M:%S')}\n\n")
+            file.write(f"{'Callback':<16}{'Calls':>10}{'Total (s)':>12}{'Mean (ms)':>12}{'Max (ms)':>12}\n")
+            for name, stats in sorted(callbacks.items()):
+                file.write(f"{name:<16}{stats.calls:>10}{stats.total:>12.3f}{stats.total / stats.calls * 1000:>12.3f}"
+                           f"{stats.max * 1000:>12.3f}\n")
+
+            if callbacks:
+                stats = pstats.Stats(profile, stream=file)
+                file.write("\nTop functions by cumulative time\n")
+                stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.top)
+                file.write("\nTop functions by own time\n")
+                stats.sort_stats(pstats.SortKey.TIME).print_stats(self.top)
+                stats.dump_stats(self.path("prof"))
+        return path
@@ -0,0 +1,590 @@
+# Dahua VTO Dz
+#
+# Sans-IO implementation of the DHIP protocol spoken by Dahua VTO doorbells. The protocol is fed with the bytes
+# received from the VTO and returns the events those bytes caused; the bytes to write to the VTO are collected until
+# they are fetched with data_to_send(). It does not depend on Domoticz, sockets or an event loop.
+#
+from typing import Callable
+from contextlib import contextmanager
+import struct
+import json
+import hashlib
+import heapq
+import time
+
+from .outbound import OutboundQueue, OutboundRequest
+
+DHIP_MAGIC = b"\x20\x00\x00\x00DHIP"
+# Magic (8), session and request id (8), packet length, 0, total length, 0
+DHIP_HEADER = struct.Struct("<8s8sLLLL")
+DHIP_NO_ID = bytes(8)
+
+
+def encode_message(data) -> bytes:
+    message_data = json.dumps(data, separators=(",", ":")).encode("utf-8")
+    length = len(message_data)
+
+    return DHIP_HEADER.pack(DHIP_MAGIC, DHIP_NO_ID, length, 0, length, 0) + message_data
+
+
+def hash_password(random, realm, username, password):
+    password_str = f"{username}:{realm}:{password}"
+    password_bytes = password_str.encode('utf-8')
+    password_hash = hashlib.md5(password_bytes).hexdigest().upper()
+
+    random_str = f"{username}:{random}:{password_hash}"
+    random_bytes = random_str.encode('utf-8')
+    random_hash = hashlib.md5(random_bytes).hexdigest().upper()
+
+    return random_hash
+
+
+class DHIPFrameDecoder:
+    def __init__(self, max_buffer_size: int = 65536, on_error: Callable = None):
+        # Fixed size receive buffer; frames are parsed in place and the remainder is moved to the front
+        self.buffer = bytearray(max_buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.on_error = on_error
+        self.frames = 0
+        self.parse_failures = 0
+        self.dropped_bytes = 0
+        self.resyncs = 0
+        self.synced = True
+
+    @property
+    def max_buffer_size(self):
+        return len(self.buffer)
+
+    def feed(self, data) -> list:
+        messages = []
+        data = memoryview(data)
+
+        while len(data) > 0:
+            if self.end == len(self.buffer):
+                self.compact()
+                if self.end == len(self.buffer):
+                    # The buffer is full with a frame that can never complete; drop it
+                    self.resync(self.start + 1)
+                    continue
+
+            size = min(len(data), len(self.buffer) - self.end)
+            self.buffer[self.end:self.end + size] = data[:size]
+            self.end += size
+            data = data[size:]
+
+            self.parse(messages)
+
+        return messages
+
+    def parse(self, messages: list):
+        while self.end - self.start >= DHIP_HEADER.size:
+            start = self.start
+            if not self.buffer.startswith(DHIP_MAGIC, start):
+                self.resync(start + 1)
+                continue
+
+            self.synced = True
+            _, _, length, _, _, _ = DHIP_HEADER.unpack_from(self.buffer, start)
+            if length > len(self.buffer) - DHIP_HEADER.size:
+                # Corrupt header; the frame would never fit in the buffer
+                self.resync(start + 1)
+                continue
+
+            end = start + DHIP_HEADER.size + length
+            if end > self.end:
+                # Partial frame, wait for more data
+                break
+
+            self.frames += 1
+            message = self.decode_payload(self.view[start + DHIP_HEADER.size:end])
+            if message is not None:
+                messages.append(message)
+            self.start = end
+
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    def resync(self, position: int):
+        # Skip ahead to the next magic header, or keep the tail, which might hold the start of one
+        next_start = self.buffer.find(DHIP_MAGIC, position, self.end)
+        if next_start < 0:
+            next_start = max(position, self.end - len(DHIP_MAGIC) + 1)
+
+        self.dropped_bytes += next_start - self.start
+        self.start = next_start
+        if self.synced:
+            # Count each run of garbage once, however many chunks it is spread over
+            self.synced = False
+            self.resyncs += 1
+
+    def compact(self):
+        if self.start > 0:
+            remaining = self.end - self.start
+            self.buffer[:remaining] = bytes(self.view[self.start:self.end])
+            self.start = 0
+            self.end = remaining
+
+    def reset(self):
+        self.start = self.end = 0
+        self.synced = True
+
+    def decode_payload(self, payload):
+        try:
+            # Decode straight from the receive buffer; the VTO may pad the JSON with null bytes
+            return json.loads(str(payload, "utf-8").rstrip("\x00"))
+        except Exception as e:
+            self.parse_failures += 1
+            if self.on_error is not None:
+                self.on_error(bytes(payload), e)
+            return None
+
+
+class PendingRequest:
+    __slots__ = ("request_id", "method", "handler", "single_response", "deadline", "on_timeout", "internal", "sent_at")
+
+    def __init__(self, request_id: int, method: str, handler: Callable, single_response: bool = True,
+                 deadline: float = None, on_timeout: Callable = None, internal: bool = False, sent_at: float = None):
+        self.request_id = request_id
+        self.method = method
+        self.handler = handler
+        self.single_response = single_response
+        self.deadline = deadline
+        self.on_timeout = on_timeout
+        self.internal = internal
+        self.sent_at = sent_at
+
+
+class PendingRequests:
+    def __init__(self):
+        self.requests = {}
+        self.by_method = {}
+        # Heap of (deadline, request id); cancelled requests are skipped when they reach the top
+        self.deadlines = []
+        # Number of requests awaiting their single response
+        self.in_flight = 0
+
+    def __len__(self):
+        return len(self.requests)
+
+    def add(self, request: PendingRequest):
+        self.requests[request.request_id] = request
+        self.by_method.setdefault(request.method, {})[request.request_id] = request
+        if request.single_response:
+            self.in_flight += 1
+        if request.deadline is not None:
+            heapq.heappush(self.deadlines, (request.deadline, request.request_id))
+
+    def get(self, request_id) -> PendingRequest:
+        return self.requests.get(request_id)
+
+    def pop(self, request_id) -> PendingRequest:
+        request = self.requests.pop(request_id, None)
+        if request is not None:
+            requests = self.by_method[request.method]
+            del requests[request_id]
+            if not requests:
+                del self.by_method[request.method]
+            if request.single_response:
+                self.in_flight -= 1
+        return request
+
+    def cancel_method(self, method: str, handler: Callable = None) -> list:
+        cancelled = [request for request in self.by_method.get(method, {}).values()
+                     if handler is None or request.handler == handler]
+        for request in cancelled:
+            self.pop(request.request_id)
+        return cancelled
+
+    def reap(self, now: float) -> list:
+        expired = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, request_id = heapq.heappop(self.deadlines)
+            request = self.requests.get(request_id)
+            if request is not None and request.deadline == deadline:
+                expired.append(self.pop(request_id))
+        return expired
+
+    def suspend(self, request_ids) -> dict:
+        # Takes the deadlines off the requests, e.g. while they wait in a system.multicall; returns their timeouts
+        timeouts = {}
+        for request_id in request_ids:
+            request = self.requests.get(request_id)
+            if request is not None and request.deadline is not None:
+                timeouts[request_id] = request.deadline - request.sent_at
+                request.deadline = None
+        return timeouts
+
+    def resume(self, timeouts: dict, now: float):
+        # Suspended requests that are still pending time out again, counted from now
+        for request_id, timeout in timeouts.items():
+            request = self.requests.get(request_id)
+            if request is not None and request.deadline is None:
+                request.deadline = now + timeout
+                request.sent_at = now
+                heapq.heappush(self.deadlines, (request.deadline, request_id))
+
+    def clear(self):
+        self.requests.clear()
+        self.by_method.clear()
+        self.deadlines.clear()
+        self.in_flight = 0
+
+
+class ProtocolEvent:
+    __slots__ = ()
+
+
+class LoggedIn(ProtocolEvent):
+    __slots__ = ("session_id", "keep_alive_interval", "params")
+
+    def __init__(self, session_id, keep_alive_interval, params: dict):
+        self.session_id = session_id
+        self.keep_alive_interval = keep_alive_interval
+        self.params = params
+
+
+class LoginFailed(ProtocolEvent):
+    __slots__ = ("message",)
+
+    def __init__(self, message: dict):
+        self.message = message
+
+
+class Response(ProtocolEvent):
+    __slots__ = ("request", "message")
+
+    def __init__(self, request: PendingRequest, message: dict):
+        self.request = request
+        self.message = message
+
+
+class RequestTimedOut(ProtocolEvent):
+    __slots__ = ("request",)
+
+    def __init__(self, request: PendingRequest):
+        self.request = request
+
+
+class UnhandledMessage(ProtocolEvent):
+    __slots__ = ("message",)
+
+    def __init__(self, message: dict):
+        self.message = message
+
+
+class EventReceived(ProtocolEvent):
+    __slots__ = ("code", "action", "index", "data", "event")
+
+    def __init__(self, event: dict):
+        self.code = event.get("Code")
+        self.action = event.get("Action")
+        self.index = event.get("Index")
+        self.data = event.get("Data")
+        self.event = event
+
+
+class Subscribed(ProtocolEvent):
+    __slots__ = ("codes",)
+
+    def __init__(self, codes: list):
+        self.codes = codes
+
+
+class SubscriptionRejected(ProtocolEvent):
+    __slots__ = ("codes", "message")
+
+    def __init__(self, codes: list, message: dict):
+        self.codes = codes
+        self.message = message
+
+
+class MulticallRejected(ProtocolEvent):
+    __slots__ = ("message",)
+
+    def __init__(self, message: dict):
+        self.message = message
+
+
+class InvalidFrame(ProtocolEvent):
+    __slots__ = ("payload", "error")
+
+    def __init__(self, payload: bytes, error: Exception):
+        self.payload = payload
+        self.error = error
+
+
+class StreamResynced(ProtocolEvent):
+    __slots__ = ("dropped_bytes", "resyncs")
+
+    def __init__(self, dropped_bytes: int, resyncs: int):
+        self.dropped_bytes = dropped_bytes
+        self.resyncs = resyncs
+
+
+class VTOProtocol:
+    def __init__(self, username: str = "", password: str = "", max_buffer_size: int = 65536,
+                 request_timeout: float = 10, clock: Callable = time.monotonic, max_in_flight: int = 4):
+        self.username = username
+        self.password = password
+        self.request_timeout = request_timeout
+        self.clock = clock
+        self.decoder = DHIPFrameDecoder(max_buffer_size, self.handle_invalid_frame)
+        self.pending = PendingRequests()
+        self.queue = OutboundQueue(max_in_flight)
+        self.events = []
+        self.outgoing = []
+        self.outbox = None
+        self.frames_sent = 0
+        # Firmware capabilities; these outlive a session
+        self.multicall_supported = True
+        self.subscribe_all = False
+        self.request_id = 1
+        self.session_id = 0
+        self.realm = None
+        self.random = None
+        self.logged_in = False
+        self.keep_alive_interval = None
+        self.event_codes = None
+
+    def reset(self):
+        self.request_id = 1
+        self.session_id = 0
+        self.realm = None
+        self.random = None
+        self.logged_in = False
+        self.keep_alive_interval = None
+        self.event_codes = None
+        self.pending.clear()
+        self.queue.clear()
+        self.decoder.reset()
+        self.outgoing.clear()
+        self.outbox = None
+
+    def connection_made(self):
+        self.reset()
+        self.pre_login()
+
+    def connection_lost(self):
+        self.reset()
+
+    def data_to_send(self) -> bytes:
+        data = b"".join(self.outgoing)
+        self.outgoing.clear()
+        return data
+
+    def take_events(self) -> list:
+        events = self.events
+        self.events = []
+        return events
+
+    def receive_data(self, data) -> list:
+        resyncs = self.decoder.resyncs
+
+        for message in self.decoder.feed(data):
+            self.handle_message(message)
+
+        if self.decoder.resyncs != resyncs:
+            self.events.append(StreamResynced(self.decoder.dropped_bytes, self.decoder.resyncs))
+
+        self.send_queued()
+        return self.take_events()
+
+    def expire(self, now: float = None) -> list:
+        for request in self.pending.reap(self.clock() if now is None else now):
+            if request.internal and request.on_timeout is not None:
+                request.on_timeout(request)
+            else:
+                self.events.append(RequestTimedOut(request))
+
+        self.send_queued()
+        return self.take_events()
+
+    def request(self, method: str, params=None, handler: Callable = None, single_response: bool = True,
+                instance_id: int = None, timeout: float = None, on_timeout: Callable = None,
+                internal: bool = False) -> int:
+        if params is None:
+            params = {}
+
+        self.request_id += 1
+
+        message_data = {
+            "id": self.request_id,
+            "session": self.session_id,
+            "method": method,
+            "params": params
+        }
+
+        if instance_id is not None:
+            message_data["object"] = instance_id
+
+        if handler is not None:
+            now = self.clock()
+            deadline = None
+            if single_response:
+                deadline = now + (timeout if timeout is not None else self.request_timeout)
+            self.pending.add(PendingRequest(self.request_id, method, handler, single_response, deadline,
+                                            on_timeout, internal, now))
+
+        if self.outbox is not None:
+            self.outbox.append(message_data)
+        else:
+            self.outgoing.append(encode_message(message_data))
+            self.frames_sent += 1
+
+        return self.request_id
+
+    def submit(self, priority: int, method: str, params=None, handler: Callable = None, single_response: bool = True,
+               instance_id: int = None, timeout: float = None, on_timeout: Callable = None) -> bool:
+        # Queued requests are sent by priority once there is room; returns False when not logged in
+        if not self.logged_in:
+            return False
+
+        self.queue.put(OutboundRequest(priority, method, params, handler, single_response, instance_id, timeout,
+                                       on_timeout))
+        self.send_queued()
+        return True
+
+    def send_queued(self):
+        if not self.queue:
+            return
+
+        for request in self.queue.take(self.pending.in_flight):
+            self.request(request.method, request.params, request.handler, request.single_response,
+                         request.instance_id, request.timeout, request.on_timeout)
+
+    @contextmanager
+    def batch(self, multicall: bool = False):
+        # Requests made within the batch are written at once, or as one system.multicall request
+        if self.outbox is not None:
+            yield
+            return
+
+        self.outbox = []
+        try:
+            yield
+        finally:
+            calls = self.outbox
+            self.outbox = None
+            if len(calls) > 1 and multicall and self.multicall_supported:
+                # The calls time out with the system.multicall request instead of on their own
+                timeouts = self.pending.suspend(call["id"] for call in calls)
+                self.request("system.multicall", calls, lambda data: self.handle_multicall(calls, timeouts, data),
+                             on_timeout=lambda request: self.handle_multicall_timeout(calls, timeouts),
+                             internal=True)
+            elif calls:
+                self.outgoing.append(b"".join(encode_message(call) for call in calls))
+                self.frames_sent += len(calls)
+
+    def handle_multicall(self, calls, timeouts: dict, data):
+        result = data.get("result")
+        replies = data.get("params")
+
+        if result and isinstance(replies, list):
+            for reply in replies:
+                self.handle_message(reply)
+            # Calls left without a reply time out on their own
+            self.pending.resume(timeouts, self.clock())
+        else:
+            self.reject_multicall(calls, timeouts, data)
+
+    def handle_multicall_timeout(self, calls, timeouts: dict):
+        self.reject_multicall(calls, timeouts, {"method": "system.multicall", "error": {"message": "Request timed out"}})
+
+    def reject_multicall(self, calls, timeouts: dict, message: dict):
+        # Falls back to sending the calls one by one, now and from then on
+        self.multicall_supported = False
+        self.events.append(MulticallRejected(message))
+        self.pending.resume(timeouts, self.clock())
+        self.outgoing.append(b"".join(encode_message(call) for call in calls))
+        self.frames_sent += len(calls)
+
+    def handle_message(self, message):
+        message_id = message.get("id")
+
+        request = self.pending.get(message_id)
+        if request is None:
+            self.events.append(UnhandledMessage(message))
+            return
+
+        if request.single_response:
+            self.pending.pop(message_id)
+
+        if request.internal:
+            request.handler(message)
+        else:
+            self.events.append(Response(request, message))
+
+    def handle_invalid_frame(self, payload: bytes, error: Exception):
+        self.events.append(InvalidFrame(payload, error))
+
+    def pre_login(self):
+        request_data = {
+            "clientType": "",
+            "ipAddr": "(null)",
+            "loginType": "Direct",
+            "userName": self.username,
+            "password": ""
+        }
+
+        self.request("global.login", request_data, self.handle_pre_login, internal=True)
+
+    def handle_pre_login(self, data):
+        error = data.get("error")
+        params = data.get("params")
+
+        if error is not None and error.get("message") == "Component error: login challenge!":
+            self.random = params.get("random")
+            self.realm = params.get("realm")
+            self.session_id = data.get("session")
+
+            self.login()
+        else:
+            self.events.append(LoginFailed(data))
+
+    def login(self):
+        password = hash_password(self.random, self.realm, self.username, self.password)
+        request_data = {
+            "clientType": "",
+            "ipAddr": "(null)",
+            "loginType": "Direct",
+            "userName": self.username,
+            "password": password,
+            "authorityType": "Default"
+        }
+
+        self.request("global.login", request_data, self.handle_login, internal=True)
+
+    def handle_login(self, data):
+        if not data.get("result"):
+            self.events.append(LoginFailed(data))
+            return
+
+        params = data.get("params") or {}
+        self.logged_in = True
+        self.keep_alive_interval = params.get("keepAliveInterval")
+        self.events.append(LoggedIn(self.session_id, self.keep_alive_interval, params))
+
+    def attach_events(self, codes: list) -> int:
+        # Firmware that rejected a list of codes before only gets subscribed to all events
+        self.event_codes = ["All"] if self.subscribe_all else codes
+
+        return self.request("eventManager.attach", {"codes": self.event_codes}, self.handle_event_stream, False,
+                            internal=True)
+
+    def handle_event_stream(self, data):
+        method = data.get("method")
+
+        if method == "client.notifyEventStream":
+            for event in data.get("params").get("eventList"):
+                self.events.append(EventReceived(event))
+        elif method is None and data.get("result"):
+            self.events.append(Subscribed(self.event_codes))
+        elif method is None and self.event_codes != ["All"]:
+            self.pending.pop(data.get("id"))
+            self.subscribe_all = True
+            self.events.append(SubscriptionRejected(self.event_codes, data))
+            self.attach_events(["All"])
+        else:
+            self.events.append(SubscriptionRejected(self.event_codes, data))
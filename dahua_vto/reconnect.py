@@ -0,0 +1,80 @@
+# Dahua VTO Dz
+#
+# Reconnect policy with jittered exponential backoff, separately for network and authentication failures
+#
+from typing import Callable
+import random
+
+FAILURE_NETWORK = "network"
+FAILURE_AUTH = "auth"
+
+
+class Backoff:
+    __slots__ = ("initial", "maximum", "factor", "jitter", "attempt", "rng")
+
+    def __init__(self, initial: float, maximum: float, factor: float = 2, jitter: float = 0.5,
+                 rng: Callable = random.random):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.attempt = 0
+        self.rng = rng
+
+    def next_delay(self) -> float:
+        delay = min(self.initial * self.factor ** self.attempt, self.maximum)
+        if delay < self.maximum:
+            self.attempt += 1
+        # Up to jitter of the delay is taken off, so VTOs that went down together do not reconnect in lockstep
+        return delay * (1 - self.jitter * self.rng())
+
+    def reset(self):
+        self.attempt = 0
+
+
+class ReconnectPolicy:
+    # A session that lasted this many seconds resets the backoff; shorter sessions count as failed attempts
+    stable_after = 60
+
+    def __init__(self, network: Backoff = None, auth: Backoff = None):
+        # Network failures are retried almost right away; the VTO may lock the account after failed logins
+        self.backoffs = {
+            FAILURE_NETWORK: network if network is not None else Backoff(1, 300),
+            FAILURE_AUTH: auth if auth is not None else Backoff(60, 1800),
+        }
+        self.attempts = 0
+        self.failures = {FAILURE_NETWORK: 0, FAILURE_AUTH: 0}
+        self.connected_at = None
+        self.disconnected_at = None
+        self.disconnected_time = 0.0
+
+    def next_delay(self, failure: str, now: float) -> float:
+        if self.connected_at is not None:
+            if now - self.connected_at >= self.stable_after:
+                self.reset()
+            self.connected_at = None
+        if self.disconnected_at is None:
+            self.disconnected_at = now
+
+        self.attempts += 1
+        self.failures[failure] += 1
+        return self.backoffs[failure].next_delay()
+
+    def on_connected(self, now: float) -> float:
+        # Returns how long the connection was down
+        downtime = 0.0
+        if self.disconnected_at is not None:
+            downtime = now - self.disconnected_at
+            self.disconnected_time += downtime
+            self.disconnected_at = None
+        self.connected_at = now
+        return downtime
+
+    def reset(self):
+        for backoff in self.backoffs.values():
+            backoff.reset()
+
+    def time_disconnected(self, now: float) -> float:
+        if self.disconnected_at is None:
+            return self.disconnected_time
+        return self.disconnected_time + now - self.disconnected_at
@@ -0,0 +1,135 @@
+# Dahua VTO Dz
+#
+# Replays a capture through the plugin as fast as possible, with the fake Domoticz module standing in for Domoticz:
+#
+#   python -m dahua_vto.replay capture.bin
+#
+# The plugin has to make the same requests as during the capture, so the responses match their request ids. Pass the
+# options of the captured plugin (without metadata_cache) with --options when they differ from the defaults.
+#
+import argparse
+import importlib
+import json
+import os
+import sys
+import time
+
+from . import fake_domoticz
+from .capture import DIRECTION_CONNECT, DIRECTION_DISCONNECT, DIRECTION_IN, read_capture
+from .protocol import DHIPFrameDecoder
+
+PLUGIN_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_plugin():
+    fake_domoticz.install()
+    if PLUGIN_FOLDER not in sys.path:
+        sys.path.insert(0, PLUGIN_FOLDER)
+    return importlib.import_module("plugin")
+
+
+class PayloadDecoder(DHIPFrameDecoder):
+    # Only splits the stream into frames; the payloads are returned as they are
+    def decode_payload(self, payload):
+        return bytes(payload)
+
+
+def load_records(path: str) -> list:
+    # A capture made while the plugin was already connected gets a connect up front, so it can be replayed as well
+    records = [(direction, data) for _, direction, data in read_capture(path)]
+    if records and records[0][0] != DIRECTION_CONNECT:
+        records.insert(0, (DIRECTION_CONNECT, b""))
+    return records
+
+
+def count_frames(records: list):
+    # Returns the number of received frames and events
+    decoder = DHIPFrameDecoder(1 << 24)
+    frames = 0
+    events = 0
+    for direction, data in records:
+        if direction == DIRECTION_CONNECT:
+            decoder.reset()
+        elif direction == DIRECTION_IN:
+            for message in decoder.feed(data):
+                frames += 1
+                if message.get("method") == "client.notifyEventStream":
+                    events += len(message.get("params", {}).get("eventList", []))
+    return frames, events
+
+
+class Replay:
+    def __init__(self, records: list, options: str = ""):
+        self.records = records
+        self.options = options
+        self.plugin_module = load_plugin()
+        self.plugin = None
+        self.endpoint = None
+
+    def start(self):
+        fake_domoticz.reset()
+        # The cache would change the requests after login, and with them the request ids
+        options = ";".join(option for option in (self.options, "metadata_cache=off") if option)
+        fake_domoticz.Parameters.update({"Address": "127.0.0.1", "Port": "5000", "Mode1": "", "Mode2": options,
+                                         "Mode6": "Normal"})
+        self.plugin = self.plugin_module.DahuaVTODz()
+        self.plugin.on_start()
+        self.endpoint = self.plugin.endpoints[0]
+
+    def run(self):
+        for record in self.records:
+            self.handle(record)
+
+    def handle(self, record):
+        direction, data = record
+        endpoint = self.endpoint
+        if direction == DIRECTION_IN:
+            endpoint.on_message(data)
+        elif direction == DIRECTION_CONNECT:
+            if endpoint.connection is None:
+                endpoint.connect()
+            endpoint.on_connect(0, "")
+        elif direction == DIRECTION_DISCONNECT:
+            endpoint.on_disconnect()
+        if endpoint.connection is not None:
+            endpoint.connection.sent.clear()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m dahua_vto.replay",
+                                     description="Replay a capture of a Dahua VTO through the plugin.")
+    parser.add_argument("capture")
+    parser.add_argument("-o", "--options", default="", help="options of the captured plugin")
+    parser.add_argument("-n", "--repeat", type=int, default=1)
+    parser.add_argument("-v", "--verbose", action="store_true", help="print the log of the plugin")
+    args = parser.parse_args(argv)
+
+    records = load_records(args.capture)
+    frames, events = count_frames(records)
+    fake_domoticz.verbose = args.verbose
+    replay = Replay(records, args.options)
+
+    elapsed = 0.0
+    for _ in range(args.repeat):
+        replay.start()
+        start = time.perf_counter()
+        replay.run()
+        elapsed += time.perf_counter() - start
+
+    devices = {unit: device.sValue for unit, device in fake_domoticz.Devices.items()}
+    result = {
+        "records": len(records),
+        "frames": frames * args.repeat,
+        "events": events * args.repeat,
+        "seconds": round(elapsed, 6),
+        "frames_per_second": round(frames * args.repeat / elapsed) if elapsed else None,
+        "events_per_second": round(events * args.repeat / elapsed) if elapsed else None,
+        "device_updates": fake_domoticz.device_updates,
+        "devices": devices,
+    }
+    print(json.dumps(result, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
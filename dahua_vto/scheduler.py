@@ -0,0 +1,55 @@
+# Dahua VTO Dz
+#
+# Timer scheduler based on monotonic deadlines
+#
+from typing import Callable
+import heapq
+import time
+
+
+class Timer:
+    __slots__ = ("deadline", "callback", "args", "cancelled")
+
+    def __init__(self, deadline: float, callback: Callable, args: tuple):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerScheduler:
+    def __init__(self, clock: Callable = time.monotonic):
+        self.clock = clock
+        # Heap of (deadline, sequence, timer); the sequence keeps timers with equal deadlines in order
+        self.timers = []
+        self.sequence = 0
+
+    def call_later(self, delay: float, callback: Callable, *args) -> Timer:
+        return self.call_at(self.clock() + delay, callback, *args)
+
+    def call_at(self, deadline: float, callback: Callable, *args) -> Timer:
+        timer = Timer(deadline, callback, args)
+        self.sequence += 1
+        heapq.heappush(self.timers, (deadline, self.sequence, timer))
+        return timer
+
+    def next_deadline(self):
+        while self.timers and self.timers[0][2].cancelled:
+            heapq.heappop(self.timers)
+        return self.timers[0][0] if self.timers else None
+
+    def run_due(self, now: float = None) -> int:
+        if now is None:
+            now = self.clock()
+
+        count = 0
+        while self.timers and self.timers[0][0] <= now:
+            _, _, timer = heapq.heappop(self.timers)
+            if not timer.cancelled:
+                timer.cancelled = True
+                timer.callback(*timer.args)
+                count += 1
+        return count
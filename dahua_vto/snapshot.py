@@ -0,0 +1,247 @@
+# Dahua VTO Dz
+#
+# Snapshots from the HTTP snapshot endpoint of a VTO. The client keeps its connection open and holds on to the digest
+# challenge of the VTO, so a snapshot takes a single round trip; a worker thread fetches the snapshots and keeps the
+# connection warm, and the snapshots are stored with a limit on their number and total size.
+#
+from typing import Callable
+from collections import deque
+import hashlib
+import http.client
+import os
+import queue
+import re
+import threading
+import time
+
+SNAPSHOT_PATH = "/cgi-bin/snapshot.cgi?channel={channel}"
+CHALLENGE_PARAM = re.compile(r'(\w+)=(?:"([^"]*)"|([^,\s]*))')
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def parse_challenge(header: str) -> dict:
+    scheme, _, params = header.partition(" ")
+    if scheme.lower() != "digest":
+        raise SnapshotError(f"Unsupported authentication: {header}")
+    return {key.lower(): quoted or plain for key, quoted, plain in CHALLENGE_PARAM.findall(params)}
+
+
+def md5_hex(value: str) -> str:
+    return hashlib.md5(value.encode("utf-8")).hexdigest()
+
+
+def digest_response(challenge: dict, username: str, password: str, method: str, uri: str, nc: str,
+                    cnonce: str) -> str:
+    ha1 = md5_hex(f"{username}:{challenge.get('realm', '')}:{password}")
+    ha2 = md5_hex(f"{method}:{uri}")
+    if "qop" in challenge:
+        return md5_hex(f"{ha1}:{challenge['nonce']}:{nc}:{cnonce}:auth:{ha2}")
+    return md5_hex(f"{ha1}:{challenge['nonce']}:{ha2}")
+
+
+class SnapshotClient:
+    timeout = 5
+    attempts = 3
+
+    def __init__(self, host: str, port: int = 80, username: str = "", password: str = "", channel: int = 1):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.path = SNAPSHOT_PATH.format(channel=channel)
+        self.connection = None
+        self.challenge = None
+        self.nonce_count = 0
+
+    def authorization(self) -> str:
+        # The challenge is reused for every request, with an increasing nonce count
+        challenge = self.challenge
+        self.nonce_count += 1
+        nc = f"{self.nonce_count:08x}"
+        cnonce = os.urandom(8).hex()
+        response = digest_response(challenge, self.username, self.password, "GET", self.path, nc, cnonce)
+        fields = [f'username="{self.username}"', f'realm="{challenge.get("realm", "")}"',
+                  f'nonce="{challenge["nonce"]}"', f'uri="{self.path}"', f'response="{response}"']
+        if "qop" in challenge:
+            fields.extend(("qop=auth", f"nc={nc}", f'cnonce="{cnonce}"'))
+        if "opaque" in challenge:
+            fields.append(f'opaque="{challenge["opaque"]}"')
+        if "algorithm" in challenge:
+            fields.append(f"algorithm={challenge['algorithm']}")
+        return "Digest " + ", ".join(fields)
+
+    def request(self, authorize: bool) -> tuple:
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+        headers = {"Authorization": self.authorization()} if authorize else {}
+        self.connection.request("GET", self.path, headers=headers)
+        response = self.connection.getresponse()
+        body = response.read()
+        if response.will_close:
+            self.close()
+        if response.status == 401:
+            header = response.getheader("WWW-Authenticate")
+            if header is None:
+                raise SnapshotError("Unauthorized without authentication challenge")
+            self.challenge = parse_challenge(header)
+            self.nonce_count = 0
+        return response.status, body
+
+    def fetch(self) -> bytes:
+        error = None
+        for _ in range(self.attempts):
+            try:
+                status, body = self.request(self.challenge is not None)
+            except (OSError, http.client.HTTPException) as e:
+                # The VTO may have closed the kept alive connection; retry on a new one
+                self.close()
+                error = e
+                continue
+
+            if status == 200:
+                return body
+            if status != 401:
+                raise SnapshotError(f"Snapshot request failed with HTTP status {status}")
+            error = SnapshotError("Snapshot request not authorized; check the username and password")
+        raise SnapshotError(str(error))
+
+    def warm(self):
+        # Opens the connection and gets a fresh challenge, without taking a snapshot
+        try:
+            status, _ = self.request(False)
+        except (OSError, http.client.HTTPException) as e:
+            self.close()
+            raise SnapshotError(str(e))
+        if status not in (200, 401):
+            raise SnapshotError(f"Snapshot request failed with HTTP status {status}")
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class SnapshotStore:
+    def __init__(self, folder: str, max_files: int = 50, max_bytes: int = 50 * 1024 * 1024):
+        self.folder = folder
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        os.makedirs(folder, exist_ok=True)
+        # Snapshots from oldest to newest; their names sort by time
+        self.files = deque()
+        self.size = 0
+        for name in sorted(os.listdir(folder)):
+            if name.startswith("snapshot-") and name.endswith(".jpg"):
+                path = os.path.join(folder, name)
+                self.files.append((path, os.path.getsize(path)))
+                self.size += self.files[-1][1]
+
+    def save(self, data: bytes, timestamp: float = None) -> str:
+        timestamp = time.time() if timestamp is None else timestamp
+        milliseconds = int(timestamp * 1000) % 1000
+        name = f"snapshot-{time.strftime('%Y%m%d-%H%M%S', time.localtime(timestamp))}-{milliseconds:03d}.jpg"
+        path = os.path.join(self.folder, name)
+        with open(path + ".tmp", "wb") as file:
+            file.write(data)
+        os.replace(path + ".tmp", path)
+
+        self.files.append((path, len(data)))
+        self.size += len(data)
+        self.prune()
+        return path
+
+    def prune(self):
+        # The newest snapshot is always kept
+        while len(self.files) > 1 and (len(self.files) > self.max_files or self.size > self.max_bytes):
+            path, size = self.files.popleft()
+            self.size -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class SnapshotResult:
+    __slots__ = ("path", "size", "latency", "error")
+
+    def __init__(self, path: str = None, size: int = 0, latency: float = None, error: Exception = None):
+        self.path = path
+        self.size = size
+        # Seconds from the trigger until the snapshot was received
+        self.latency = latency
+        self.error = error
+
+
+class SnapshotWorker:
+    # The connection is warmed up again after this many seconds without snapshots
+    warm_interval = 30
+
+    def __init__(self, client: SnapshotClient, store: SnapshotStore, name: str = "snapshot",
+                 clock: Callable = time.monotonic):
+        self.client = client
+        self.store = store
+        self.clock = clock
+        # A press while a snapshot is being taken is dropped rather than queued
+        self.requests = queue.Queue(1)
+        self.results = deque()
+        self.warm_error = None
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self, timeout: float = 5):
+        self.stopping = True
+        try:
+            self.requests.put_nowait(None)
+        except queue.Full:
+            pass
+        self.thread.join(timeout)
+
+    def trigger(self, triggered_at: float = None) -> bool:
+        try:
+            self.requests.put_nowait(self.clock() if triggered_at is None else triggered_at)
+            return True
+        except queue.Full:
+            return False
+
+    def take_results(self) -> list:
+        # Called from the plugin thread; deque appends and pops are thread safe
+        results = []
+        while self.results:
+            results.append(self.results.popleft())
+        return results
+
+    def run(self):
+        self.warm()
+        while not self.stopping:
+            try:
+                triggered_at = self.requests.get(timeout=self.warm_interval)
+            except queue.Empty:
+                self.warm()
+                continue
+            if triggered_at is None:
+                break
+
+            try:
+                data = self.client.fetch()
+                latency = self.clock() - triggered_at
+                self.results.append(SnapshotResult(self.store.save(data), len(data), latency))
+            except (SnapshotError, OSError) as e:
+                self.results.append(SnapshotResult(error=e))
+        self.client.close()
+
+    def warm(self):
+        try:
+            self.client.warm()
+            self.warm_error = None
+        except SnapshotError as e:
+            # Reported once, not every warm interval while the VTO is unreachable
+            if self.warm_error is None:
+                self.results.append(SnapshotResult(error=e))
+            self.warm_error = e
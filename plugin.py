@@ -11,14 +11,17 @@
         A plugin for Domoticz, which receives events from Dahua VTO Doorbells and translates those to devices into Domoticz<br/>
     </description>
     <params>
-        <param field="Address" label="IP Address" width="200px" required="true"/>
+        <param field="Address" label="IP Address(es)" width="300px" required="true"/>
         <param field="Port" label="Connection" required="true" width="200px" default="5000"/>
         <param field="Username" label="Username" width="200px"/>
         <param field="Password" label="Password" width="200px"/>
+        <param field="Mode1" label="Extra event codes" width="300px" default=""/>
+        <param field="Mode2" label="Options" width="300px" default=""/>
         <param field="Mode6" label="Debug" width="150px">
             <options>
                 <option label="True" value="Debug"/>
                 <option label="False" value="Normal" default="true" />
+                <option label="Profile" value="Profile"/>
             </options>
         </param>
     </params>
@@ -35,172 +38,477 @@ except ImportError:
     pass
 
 from typing import Callable
-import struct
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from functools import partial
 import json
+import queue
 import sys
-import hashlib
-from datetime import datetime, timedelta
-
-class DahuaVTODz:
-    enabled = False
+import os
+import threading
+import time
+import traceback
+
+from dahua_vto import (CALL_ANSWERED, CALL_CALLING, CALL_CONNECTED, CALL_ENDED, CALL_MISSED, CALL_RINGING, CALL_STARTED,
+                       DIRECTION_CONNECT, DIRECTION_DISCONNECT, DIRECTION_IN, DIRECTION_OUT, FAILURE_AUTH,
+                       FAILURE_NETWORK, KEEP_ALIVE_POLICIES, PRIORITY_DOOR, PRIORITY_KEEP_ALIVE, PRIORITY_METADATA,
+                       Backoff, CallStateMachine, CallbackProfiler, CaptureWriter, EventJournal, EventReceived,
+                       InvalidFrame, LoggedIn, LoginFailed, Metrics, MulticallRejected, PendingRequest, ReconnectPolicy,
+                       RequestTimedOut, Response, SnapshotClient, SnapshotStore, SnapshotWorker, StreamResynced,
+                       Subscribed, SubscriptionRejected, TimerScheduler, UnhandledMessage, VTOProtocol,
+                       create_keep_alive_policy)
+
+# Every VTO gets a block of device units; the first VTO uses units 1-4 like before
+UNITS_PER_ENDPOINT = 20
+MAX_ENDPOINTS = 255 // UNITS_PER_ENDPOINT
+UNIT_DOORBELL = 1
+UNIT_DOORBELL_ADVANCED = 2
+UNIT_TEMPER_ALARM = 3
+UNIT_DOOR_LOCK = 4
+# Door locks use the units after UNIT_DOOR_LOCK, one per door
+MAX_DOORS = 4
+# Optional call devices
+UNIT_MISSED_CALLS = 8
+UNIT_RING_TO_ANSWER = 9
+UNIT_CALL_DURATION = 10
+# Incremental counters; every update adds to the counter, so their updates are never coalesced
+COUNTER_UNITS = (UNIT_MISSED_CALLS,)
+# Optional metrics devices
+UNIT_METRICS_EVENTS = 11
+UNIT_METRICS_RPC_LATENCY = 12
+UNIT_METRICS_DOORBELL_LATENCY = 13
+UNIT_METRICS_RECONNECTS = 14
+UNIT_METRICS_DATA_RECEIVED = 15
+
+
+class MetadataCache:
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                entries = json.load(file)
+            self.entries = entries if isinstance(entries, dict) else {}
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        # Write to a temporary file first, so a crash never leaves a truncated cache behind
+        temporary_path = self.path + ".tmp"
+        try:
+            with open(temporary_path, "w", encoding="utf-8") as file:
+                json.dump(self.entries, file, separators=(",", ":"))
+            os.replace(temporary_path, self.path)
+        except OSError as e:
+            Domoticz.Error(f"Failed to write metadata cache {self.path}, error: {e}")
+
+    def get(self, key: str):
+        return self.entries.get(key)
+
+    def put(self, key: str, entry: dict):
+        self.entries[key] = entry
+        self.save()
+
+    def remove(self, key: str):
+        if self.entries.pop(key, None) is not None:
+            self.save()
+
+
+class DoorState:
+    __slots__ = ("index", "unit", "hold_time", "unlock_interval", "hold_until", "relock_timer", "command_sent",
+                 "awaiting_event", "event_timer", "ack_latency", "event_latency")
+
+    def __init__(self, index: int, unit: int, hold_time=0, unlock_interval=None):
+        self.index = index
+        self.unit = unit
+        self.hold_time = hold_time
+        self.unlock_interval = unlock_interval
+        self.hold_until = None
+        self.relock_timer = None
+        # Time the last open command was sent, and the latencies of its reply and OpenDoor event
+        self.command_sent = None
+        self.awaiting_event = False
+        self.event_timer = None
+        self.ack_latency = None
+        self.event_latency = None
+
+    def cancel_relock(self):
+        if self.relock_timer is not None:
+            self.relock_timer.cancel()
+            self.relock_timer = None
+
+    def cancel_event_timer(self):
+        if self.event_timer is not None:
+            self.event_timer.cancel()
+            self.event_timer = None
+
+
+class VTOEndpoint:
     connection = None
     retry_attempts = 3
-    retry_attempt_interval_next = 5
-    request_id = 1
-    session_id = 0
-    realm = None
-    random = None
+    retry_interval = 5
     access_control_factory_instance = None
-    unlock_interval = None
-    unlock_interval_next = None
-    keep_alive_interval = None
-    keep_alive_interval_next = None
     attached_to_events = False
-    data_handlers = {}
-    keep_data_handlers = []
-    dahua_details = {}
-    hold_time = 0
-    hold_time_date = None
-    prevMessage = None
-
-    def __init__(self):
-        return
-
-    def on_start(self):
-        if Parameters["Mode6"] == "Debug":
-            Domoticz.Debugging(1)
-        dump_config_to_log()
-        self.setup_devices()
-        self.connect()
-        Domoticz.Heartbeat(1)
+    metadata_keys = ("deviceType", "version", "buildDate", "serialNumber", "accessControl")
+    metadata_refresh_delay = 60
+    request_timeout = 10
+    # Door commands given while not logged in are sent after login, unless they are older than this
+    door_command_hold = 10
+    # An optimistically unlocked door is locked again when the VTO sends no OpenDoor event within this time
+    unlock_event_timeout = 5
+
+    def __init__(self, plugin, index: int, host: str, port: int, username: str, password: str):
+        self.plugin = plugin
+        self.index = index
+        self.host = host
+        self.port = port
+        self.name = f"{host}:{port}"
+        self.unit_offset = index * UNITS_PER_ENDPOINT
+        self.scheduler = plugin.scheduler
+        self.multicall = plugin.multicall
+        self.metadata_cache = plugin.metadata_cache
+        self.cached_metadata = None
+        self.dahua_details = {}
+        self.event_handlers = {}
+        self.register_default_event_handlers()
+        self.protocol_event_handlers = {
+            LoggedIn: self.handle_logged_in,
+            LoginFailed: self.handle_login_failed,
+            Response: self.handle_response,
+            RequestTimedOut: self.handle_request_timed_out,
+            UnhandledMessage: self.handle_unhandled_message,
+            EventReceived: self.handle_event_received,
+            Subscribed: self.handle_subscribed,
+            SubscriptionRejected: self.handle_subscription_rejected,
+            MulticallRejected: self.handle_multicall_rejected,
+            InvalidFrame: self.handle_invalid_frame,
+            StreamResynced: self.handle_stream_resynced,
+        }
+        self.retry_timer = None
+        self.keep_alive_timer = None
+        self.reconnect_timer = None
+        self.metadata_timer = None
+        # Incremented when the connection closes; data queued for the worker thread before that is dropped
+        self.generation = 0
+        self.doors = {}
+        self.held_door_commands = {}
+        self.capture = None
+        self.call = CallStateMachine(self.scheduler.clock)
+        self.snapshots = None
+        self.journal = None
+        self.metrics = Metrics()
+        self.metrics_timer = None
+        # Time the data being handled was received, and whether it held a doorbell event
+        self.received_at = None
+        self.doorbell_received = False
+        self.reconnect_policy = ReconnectPolicy(Backoff(1, plugin.reconnect_max))
+        self.keep_alive_policy = create_keep_alive_policy(plugin.keep_alive_policy, plugin.keep_alive_idle)
+        self.protocol = VTOProtocol(username, password, plugin.max_buffer_size, self.request_timeout,
+                                    self.scheduler.clock, plugin.max_in_flight)
+        self.restore_metadata()
+
+    @property
+    def debug(self):
+        return self.plugin.debug
+
+    @property
+    def connection_name(self):
+        return f"DahuaVTO {self.name}"
+
+    def unit(self, unit: int) -> int:
+        return self.unit_offset + unit
+
+    def units(self):
+        units = [self.unit(unit) for unit in (UNIT_DOORBELL, UNIT_DOORBELL_ADVANCED, UNIT_TEMPER_ALARM, UNIT_DOOR_LOCK)]
+        units.extend(self.unit(door.unit) for door in self.doors.values() if door.unit != UNIT_DOOR_LOCK)
+        return units
 
     def setup_devices(self):
-        if len(Devices) == 0:
-            Domoticz.Device(Name="Doorbell", Unit=1, TypeName="Switch", Switchtype=1).Create()
+        # Devices are only created when none of the devices of this VTO exist; deleted devices stay deleted
+        if not any(unit in Devices for unit in self.units()):
+            suffix = f" ({self.host})" if self.index > 0 else ""
+
+            Domoticz.Device(Name="Doorbell" + suffix, Unit=self.unit(UNIT_DOORBELL), TypeName="Switch",
+                            Switchtype=1).Create()
 
             options = {"LevelActions": "|||",
                        "LevelNames": "Off|On|Calling|Connected",
                        "LevelOffHidden": "false",
                        "SelectorStyle": "0"
                        }
-            Domoticz.Device(Name="Doorbell (Advanced)", Unit=2, TypeName="Selector Switch", Switchtype=18, Image=9,
-                            Options=options).Create()
+            Domoticz.Device(Name="Doorbell (Advanced)" + suffix, Unit=self.unit(UNIT_DOORBELL_ADVANCED),
+                            TypeName="Selector Switch", Switchtype=18, Image=9, Options=options).Create()
+
+            Domoticz.Device(Name="Temper Alarm" + suffix, Unit=self.unit(UNIT_TEMPER_ALARM), TypeName="Alert",
+                            Image=13).Create()
 
-            Domoticz.Device(Name="Temper Alarm", Unit=3, TypeName="Alert", Image=13).Create()
+            Domoticz.Device(Name="Door lock" + suffix, Unit=self.unit(UNIT_DOOR_LOCK), TypeName="Switch",
+                            Switchtype=20).Create()
 
-            Domoticz.Device(Name="Door lock", Unit=4, TypeName="Switch", Switchtype=20).Create()
+        self.update_device(UNIT_DOORBELL, 0, "Off", 1)
+        self.update_device(UNIT_DOORBELL_ADVANCED, 0, str(0), 1)  # Off
+        self.update_device(UNIT_TEMPER_ALARM, 0, "No alert", 1)
+        self.update_device(UNIT_DOOR_LOCK, 0, "Locked", 1)
+        self.setup_door_devices()
 
-        self.update_device(1, 0, "Off", 1)
-        self.update_device(2, 0, str(0), 1)  # Off
-        self.update_device(3, 0, "No alert", 1)
-        self.update_device(4, 0, "Locked", 1)
+    def setup_door_devices(self):
+        # The first door uses the original door lock device; other doors get a device once they are known, unless
+        # the door lock device of this VTO was deleted
+        if self.unit(UNIT_DOOR_LOCK) not in Devices:
+            return
+        for door in list(self.doors.values()):
+            if door.unit != UNIT_DOOR_LOCK and self.unit(door.unit) not in Devices:
+                suffix = f" ({self.host})" if self.index > 0 else ""
+                Domoticz.Device(Name=f"Door lock {door.index + 1}" + suffix, Unit=self.unit(door.unit),
+                                TypeName="Switch", Switchtype=20).Create()
+                self.update_device(door.unit, 0, "Locked")
+
+    def setup_call_devices(self):
+        suffix = f" ({self.host})" if self.index > 0 else ""
+        if self.unit(UNIT_MISSED_CALLS) not in Devices:
+            Domoticz.Device(Name="Missed calls" + suffix, Unit=self.unit(UNIT_MISSED_CALLS),
+                            TypeName="Counter Incremental", Switchtype=3,
+                            Options={"ValueQuantity": "Calls", "ValueUnits": "calls"}).Create()
+        if self.unit(UNIT_RING_TO_ANSWER) not in Devices:
+            Domoticz.Device(Name="Ring to answer" + suffix, Unit=self.unit(UNIT_RING_TO_ANSWER), TypeName="Custom",
+                            Options={"Custom": "1;s"}).Create()
+        if self.unit(UNIT_CALL_DURATION) not in Devices:
+            Domoticz.Device(Name="Call duration" + suffix, Unit=self.unit(UNIT_CALL_DURATION), TypeName="Custom",
+                            Options={"Custom": "1;s"}).Create()
+
+    def setup_metrics_devices(self):
+        suffix = f" ({self.host})" if self.index > 0 else ""
+        if self.unit(UNIT_METRICS_EVENTS) not in Devices:
+            Domoticz.Device(Name="Events" + suffix, Unit=self.unit(UNIT_METRICS_EVENTS), TypeName="Counter Incremental",
+                            Switchtype=3, Options={"ValueQuantity": "Events", "ValueUnits": "events"}).Create()
+        if self.unit(UNIT_METRICS_RPC_LATENCY) not in Devices:
+            Domoticz.Device(Name="Response time" + suffix, Unit=self.unit(UNIT_METRICS_RPC_LATENCY), TypeName="Custom",
+                            Options={"Custom": "1;ms"}).Create()
+        if self.unit(UNIT_METRICS_DOORBELL_LATENCY) not in Devices:
+            Domoticz.Device(Name="Doorbell latency" + suffix, Unit=self.unit(UNIT_METRICS_DOORBELL_LATENCY),
+                            TypeName="Custom", Options={"Custom": "1;ms"}).Create()
+        if self.unit(UNIT_METRICS_RECONNECTS) not in Devices:
+            Domoticz.Device(Name="Reconnects" + suffix, Unit=self.unit(UNIT_METRICS_RECONNECTS),
+                            TypeName="Counter Incremental", Switchtype=3,
+                            Options={"ValueQuantity": "Reconnects", "ValueUnits": "reconnects"}).Create()
+        if self.unit(UNIT_METRICS_DATA_RECEIVED) not in Devices:
+            Domoticz.Device(Name="Data received" + suffix, Unit=self.unit(UNIT_METRICS_DATA_RECEIVED),
+                            TypeName="Counter Incremental", Switchtype=3,
+                            Options={"ValueQuantity": "Data", "ValueUnits": "bytes"}).Create()
+
+    def set_timed_out(self, timed_out: int):
+        for unit in self.units():
+            if unit in Devices:
+                self.plugin.update_device(unit, Devices[unit].nValue, Devices[unit].sValue, timed_out)
 
     def connect(self):
-        self.connection = Domoticz.Connection(Name="DahuaVTO", Transport="TCP/IP", Protocol="None",
-                                              Address=Parameters["Address"], Port=Parameters["Port"])
+        self.connection = Domoticz.Connection(Name=self.connection_name, Transport="TCP/IP", Protocol="None",
+                                              Address=self.host, Port=str(self.port))
         self.connection.Connect()
 
-    def send(self, action, handler, single_response: bool = True, params=None, instance_id: int = None):
-        if params is None:
-            params = {}
-
-        self.request_id += 1
-
-        message_data = {
-            "id": self.request_id,
-            "session": self.session_id,
-            "method": action,
-            "params": params
-        }
-
-        if instance_id is not None:
-            message_data["object"] = instance_id
+    def send(self, action, handler, single_response: bool = True, params=None, instance_id: int = None,
+             timeout: float = None, on_timeout: Callable = None, priority: int = PRIORITY_METADATA) -> bool:
+        if not self.protocol.submit(priority, action, params, handler, single_response, instance_id, timeout,
+                                    on_timeout):
+            Domoticz.Debug(f"Not logged into Dahua VTO {self.name}; Not sending {action}")
+            return False
+
+        self.keep_alive_policy.on_sent(self.scheduler.clock())
+        self.transmit()
+        return True
+
+    def transmit(self):
+        data = self.protocol.data_to_send()
+        if data and self.connection is not None:
+            self.metrics.bytes_out += len(data)
+            if self.capture is not None:
+                self.capture.write(DIRECTION_OUT, data)
+            self.connection.Send(data)
+
+    def start_capture(self, folder: str):
+        path = os.path.join(folder, f"capture-{self.host}-{self.port}-{time.strftime('%Y%m%d-%H%M%S')}.bin")
+        try:
+            self.capture = CaptureWriter(path, self.scheduler.clock)
+            Domoticz.Log(f"Capturing the data of Dahua VTO {self.name} to {path}")
+        except OSError as e:
+            Domoticz.Error(f"Failed to create capture file {path}: {e}")
+
+    def start_metrics(self, interval: float):
+        self.metrics_timer = self.scheduler.call_later(interval, self.report_metrics, interval)
+
+    def report_metrics(self, interval: float):
+        self.metrics_timer = self.scheduler.call_later(interval, self.report_metrics, interval)
+        metrics = self.metrics
+        metrics.collect_protocol(self.protocol)
+        Domoticz.Log(f"Metrics of Dahua VTO {self.name} over the last {interval} seconds: {metrics.summary()}")
+
+        if self.plugin.metrics_devices:
+            # The counters are incremented by the value of the interval
+            self.update_device(UNIT_METRICS_EVENTS, 0, str(metrics.event_count()), always_update=True)
+            self.update_device(UNIT_METRICS_RECONNECTS, 0, str(metrics.reconnects), always_update=True)
+            self.update_device(UNIT_METRICS_DATA_RECEIVED, 0, str(metrics.bytes_in), always_update=True)
+            rpc_latency = metrics.rpc_latency()
+            if rpc_latency.count:
+                self.update_device(UNIT_METRICS_RPC_LATENCY, 0, f"{rpc_latency.mean() * 1000:.1f}")
+            if metrics.doorbell_latency.count:
+                self.update_device(UNIT_METRICS_DOORBELL_LATENCY, 0, f"{metrics.doorbell_latency.mean() * 1000:.1f}")
+        metrics.reset()
+
+    def open_journal(self, folder: str):
+        path = os.path.join(folder, f"journal-{self.host}-{self.port}.bin")
+        try:
+            self.journal = EventJournal(path, self.plugin.journal_size * 1024 * 1024)
+            Domoticz.Log(f"Journaling the events of Dahua VTO {self.name} to {path}")
+        except (OSError, ValueError) as e:
+            Domoticz.Error(f"Failed to open event journal {path}: {e}")
+
+    def close_journal(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def start_snapshots(self, folder: str):
+        plugin = self.plugin
+        folder = os.path.join(folder, "snapshots", f"{self.host}-{self.port}")
+        try:
+            store = SnapshotStore(folder, plugin.snapshot_files, plugin.snapshot_size * 1024 * 1024)
+        except OSError as e:
+            Domoticz.Error(f"Failed to create snapshot folder {folder}: {e}")
+            return
+        client = SnapshotClient(self.host, plugin.snapshot_port, self.protocol.username, self.protocol.password,
+                                plugin.snapshot_channel)
+        self.snapshots = SnapshotWorker(client, store, f"DahuaVTO snapshots {self.name}", self.scheduler.clock)
+        self.snapshots.start()
+        Domoticz.Log(f"Saving snapshots of Dahua VTO {self.name} to {folder}")
+
+    def stop_snapshots(self):
+        if self.snapshots is not None:
+            self.snapshots.stop()
+            self.snapshots = None
+
+    def take_snapshot(self):
+        # The snapshot is taken on the snapshot thread; the latency counts from receiving the event
+        received_at = self.received_at if self.received_at is not None else self.scheduler.clock()
+        if not self.snapshots.trigger(received_at):
+            Domoticz.Log(f"Still taking a snapshot of Dahua VTO {self.name}; Skipping this one")
+
+    def handle_snapshot_results(self):
+        for result in self.snapshots.take_results():
+            if result.error is not None:
+                Domoticz.Error(f"Failed to take a snapshot of Dahua VTO {self.name}: {result.error}")
+            else:
+                Domoticz.Log(f"Saved snapshot of Dahua VTO {self.name} to {result.path} ({result.size} bytes), "
+                             f"{result.latency * 1000:.0f} ms after the doorbell event")
 
-        if handler is not None:
-            self.data_handlers[self.request_id] = handler
-            if not single_response:
-                self.keep_data_handlers.append(self.request_id)
+    def stop_capture(self):
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
 
-        self.connection.Send(self.convert_message(message_data))
+    @contextmanager
+    def batch(self, multicall: bool = False):
+        # Requests sent within the batch are written to the connection at once, or as one system.multicall request
+        try:
+            with self.protocol.batch(multicall):
+                yield
+        finally:
+            self.transmit()
 
     def disconnect(self):
         self.connection.Disconnect()
         self.connection = None
+        self.generation += 1
+        # Until onDisconnect arrives, door commands are held for the next login instead of sent to no connection
+        self.protocol.connection_lost()
+        self.access_control_factory_instance = None
 
     def on_connect(self, status, description):
         if status == 0:
-            Domoticz.Debug("Connected to Dahua VTO successfully.")
-            self.pre_login()
+            Domoticz.Debug(f"Connected to Dahua VTO {self.name} successfully.")
+            if self.capture is not None:
+                self.capture.write(DIRECTION_CONNECT)
+            Domoticz.Log("Sending PreLogin package to Dahua VTO")
+            self.protocol.connection_made()
+            self.transmit()
         else:
-            Domoticz.Log("Failed to connect (" + str(status) + ") to: " + Parameters["Address"] + ":" + Parameters[
-                "Port"] + " with error: " + description)
-
-    def pre_login(self):
-        Domoticz.Log("Sending PreLogin package to Dahua VTO")
-
-        request_data = {
-            "clientType": "",
-            "ipAddr": "(null)",
-            "loginType": "Direct",
-            "userName": Parameters["Username"],
-            "password": ""
-        }
-
-        self.send("global.login", self.handle_pre_login, True, request_data)
-
-    def handle_pre_login(self, data):
-        error = data.get("error")
-        params = data.get("params")
-
-        if error is not None:
-            error_message = error.get("message")
-
-            if error_message == "Component error: login challenge!":
-                self.random = params.get("random")
-                self.realm = params.get("realm")
-                self.session_id = data.get("session")
-
-                self.login()
-
-    def login(self):
-        Domoticz.Log("Sending login package to Dahua VTO")
-
-        password = self.hash_password(self.random, self.realm, Parameters["Username"], Parameters["Password"])
-        request_data = {
-            "clientType": "",
-            "ipAddr": "(null)",
-            "loginType": "Direct",
-            "userName": Parameters["Username"],
-            "password": password,
-            "authorityType": "Default"
-        }
+            Domoticz.Log("Failed to connect (" + str(status) + ") to: " + self.name + " with error: " + description)
+            self.connection = None
+            self.schedule_reconnect(FAILURE_NETWORK)
+
+    def handle_login_failed(self, event: LoginFailed):
+        delay = self.schedule_reconnect(FAILURE_AUTH)
+        Domoticz.Error(f"Failed to log into Dahua VTO {self.name}; Reconnecting in ~{delay:.0f}...")
+        Domoticz.Log(f"{event.message}")
+        self.disconnect()
+
+    def handle_logged_in(self, event: LoggedIn):
+        Domoticz.Log(f"Logged into Dahua VTO {self.name} successfully.")
+        downtime = self.reconnect_policy.on_connected(self.scheduler.clock())
+        if downtime:
+            Domoticz.Log(f"Reconnected to Dahua VTO {self.name} after {downtime:.0f} seconds; "
+                         f"Attempts: {self.reconnect_policy.attempts}, "
+                         f"Total time disconnected: {self.reconnect_policy.disconnected_time:.0f} seconds")
+
+        if event.keep_alive_interval is not None:
+            self.keep_alive_policy.start(self.scheduler.clock(), event.keep_alive_interval)
+            self.schedule_keep_alive()
+            self.retry_timer = self.scheduler.call_later(self.retry_interval, self.handle_retries)
+
+            with self.batch(self.multicall):
+                if self.cached_metadata is None:
+                    self.load_device_type()
+                self.load_version()
+                self.load_serial_number()
+                if self.cached_metadata is None:
+                    self.load_access_control()
+                self.load_access_control_factory_instance()
+                self.attach_event_manager()
+
+            if self.cached_metadata is not None:
+                # Version and serial number validate the cache; the rest is refreshed once the session settled
+                self.metadata_timer = self.scheduler.call_later(self.metadata_refresh_delay, self.refresh_metadata)
+
+    def metadata_cache_key(self):
+        return self.name
+
+    def restore_metadata(self):
+        entry = self.metadata_cache.get(self.metadata_cache_key()) if self.metadata_cache is not None else None
+        if entry is None or any(key not in entry for key in self.metadata_keys):
+            return
 
-        self.send("global.login", self.handle_login, True, request_data)
+        Domoticz.Log(f"Loaded cached details of Dahua VTO with serial number: {entry['serialNumber']}")
+        self.cached_metadata = entry
+        self.dahua_details = {key: entry[key] for key in self.metadata_keys}
+        self.apply_access_control(entry["accessControl"])
 
-    def handle_login(self, data):
-        result = data.get("result")
-        if result:
-            Domoticz.Log("Logged into Dahua VTO successfully.")
-        else:
-            Domoticz.Error("Failed to log into Dahua VTO; Reconnecting in ~30...")
-            self.disconnect()
-            self.connection = None
-            self.keep_alive_interval_next = 30
+    def store_metadata(self):
+        if self.metadata_cache is None or any(key not in self.dahua_details for key in self.metadata_keys):
             return
 
-        params = data.get("params")
-        keep_alive_interval = params.get("keepAliveInterval")
+        entry = {key: self.dahua_details[key] for key in self.metadata_keys}
+        if entry != self.metadata_cache.get(self.metadata_cache_key()):
+            self.metadata_cache.put(self.metadata_cache_key(), entry)
+        self.cached_metadata = entry
 
-        if keep_alive_interval is not None:
-            self.keep_alive_interval = keep_alive_interval - 5
-            self.keep_alive_interval_next = self.keep_alive_interval
+    def validate_metadata(self, key: str):
+        if self.cached_metadata is None or self.cached_metadata.get(key) == self.dahua_details.get(key):
+            return
 
+        Domoticz.Log(f"Dahua VTO reports a different {key}; Reloading device details.")
+        self.cached_metadata = None
+        self.metadata_cache.remove(self.metadata_cache_key())
+        self.dahua_details.pop("deviceType", None)
+        self.dahua_details.pop("accessControl", None)
+        self.load_device_type()
+        self.load_access_control()
+
+    def refresh_metadata(self):
+        self.metadata_timer = None
+        with self.batch(self.multicall):
             self.load_device_type()
-            self.load_version()
-            self.load_serial_number()
             self.load_access_control()
-            self.load_access_control_factory_instance()
-            self.attach_event_manager()
 
     def load_device_type(self):
         Domoticz.Log("Getting device type from Dahua VTO")
@@ -214,6 +522,7 @@ class DahuaVTODz:
         self.dahua_details["deviceType"] = device_type
 
         Domoticz.Log(f"Device Type: {device_type}")
+        self.store_metadata()
 
     def load_version(self):
         Domoticz.Log("Getting version from Dahua VTO")
@@ -230,6 +539,8 @@ class DahuaVTODz:
         self.dahua_details["buildDate"] = build_date
 
         Domoticz.Log(f"Version: {version}, Build Date: {build_date}")
+        self.validate_metadata("version")
+        self.store_metadata()
 
     def load_serial_number(self):
         Domoticz.Log("Getting serial number from Dahua VTO")
@@ -248,6 +559,8 @@ class DahuaVTODz:
         self.dahua_details["serialNumber"] = serial_number
 
         Domoticz.Log(f"Serial Number: {serial_number}")
+        self.validate_metadata("serialNumber")
+        self.store_metadata()
 
     def load_access_control(self):
         Domoticz.Log("Getting access control configuration from Dahua VTO")
@@ -262,15 +575,26 @@ class DahuaVTODz:
         params = data.get("params")
         table = params.get("table")
 
-        for item in table:
-            access_control = item.get('AccessProtocol')
+        self.dahua_details["accessControl"] = table
+        self.apply_access_control(table)
+        self.store_metadata()
 
-            if access_control == 'Local':
-                self.hold_time = item.get('UnlockReloadInterval')
-                self.unlock_interval = item.get('UnlockHoldInterval')
+    def apply_access_control(self, table):
+        # Every entry of the AccessControl table configures a door; its position is the door index
+        for index, item in enumerate(table[:MAX_DOORS]):
+            hold_time = item.get('UnlockReloadInterval')
+            unlock_interval = item.get('UnlockHoldInterval')
 
-                Domoticz.Log(f"Hold time: {self.hold_time}")
-                Domoticz.Log(f"Unlock interval: {self.unlock_interval}")
+            door = self.doors.get(index)
+            if door is None:
+                door = self.doors[index] = DoorState(index, UNIT_DOOR_LOCK + index)
+            door.hold_time = hold_time
+            door.unlock_interval = unlock_interval
+
+            Domoticz.Log(f"Door {index + 1}, Protocol: {item.get('AccessProtocol')}, Hold time: {hold_time}, "
+                         f"Unlock interval: {unlock_interval}")
+
+        self.plugin.call_in_plugin_thread(self.setup_door_devices)
 
     def load_access_control_factory_instance(self):
         Domoticz.Log("Getting access control factory instance from Dahua VTO")
@@ -279,176 +603,273 @@ class DahuaVTODz:
             "Channel": 0
         }
 
-        self.send("accessControl.factory.instance", self.handle_access_control_factory_instance, True, request_data)
+        # Door commands wait for the instance, so it skips the queue like they do
+        self.send("accessControl.factory.instance", self.handle_access_control_factory_instance, True, request_data,
+                  priority=PRIORITY_DOOR)
 
     def handle_access_control_factory_instance(self, data):
         result = data.get("result")
         if result:
             Domoticz.Log("Loaded access control factory instance from Dahua VTO")
             self.access_control_factory_instance = result
+            self.send_held_door_commands()
         else:
             Domoticz.Error("Failed to load access control factory instance from Dahua VTO")
             Domoticz.Log(f"{data}")
 
     def attach_event_manager(self):
-        Domoticz.Log("Subscribing to Dahua's events")
+        codes = self.event_codes()
+        Domoticz.Log(f"Subscribing to Dahua's events: {', '.join(codes)}")
 
-        request_data = {
-            "codes": ['All']
-        }
+        self.plugin.call_in_plugin_thread(self.set_timed_out, 0)
 
-        self.update_device(1, Devices[1].nValue, Devices[1].sValue)
-        self.update_device(2, Devices[2].nValue, Devices[2].sValue)
-        self.update_device(3, Devices[3].nValue, Devices[3].sValue)
-        self.update_device(4, Devices[4].nValue, Devices[4].sValue)
+        self.protocol.attach_events(codes)
+        self.transmit()
 
-        self.send("eventManager.attach", self.handle_notify_event_stream, False, request_data)
+    def event_codes(self) -> list:
+        # Only subscribe to the events that are handled, unless the firmware requires a subscription to all events
+        codes = {code for code, _ in self.event_handlers} | set(self.plugin.extra_event_codes)
+        if self.protocol.subscribe_all or "All" in codes:
+            return ["All"]
+        return sorted(codes)
 
-    def handle_notify_event_stream(self, data):
-        self.attached_to_events = True
-        method = data.get("method")
-        params = data.get("params")
+    def register_event_handler(self, code: str, action: str, handler: Callable):
+        # A handler registered without action receives every action of the code
+        self.event_handlers[(code, action)] = handler
 
-        if method == "client.notifyEventStream":
-            try:
-                event_list = params.get("eventList")
+    def register_default_event_handlers(self):
+        self.register_event_handler("BackKeyLight", "Pulse", self.handle_back_key_light_event)
+        self.register_event_handler("AccessControl", "Pulse", self.handle_access_control_event)
+        self.register_event_handler("ProfileAlarmTransmit", "Start", self.handle_profile_alarm_transmit_event)
+        self.register_event_handler("ProfileAlarmTransmit", "Stop", self.handle_profile_alarm_transmit_event)
 
-                for event in event_list:
-                    action = event.get("Action")
-                    code = event.get("Code")
-                    if Parameters["Mode6"] == "Debug":
-                        Domoticz.Debug(f"Got event, action: {action}, code: {code}")
-                        Domoticz.Debug(f"{event}")
+    def handle_subscribed(self, event: Subscribed):
+        self.attached_to_events = True
 
-                    if action == "Pulse" and code == "BackKeyLight":
-                        data = event.get("Data")
-                        state = data.get('State')
-                        self.handle_doorbell_state(state)
+    @staticmethod
+    def handle_subscription_rejected(event: SubscriptionRejected):
+        Domoticz.Error(f"Dahua VTO rejected the subscription to events: {', '.join(event.codes)}; "
+                       f"Subscribing to all events.")
+        Domoticz.Log(f"{event.message}")
+
+    def handle_event_received(self, event: EventReceived):
+        code = event.code
+        action = event.action
+        self.metrics.count_event(code, action)
+        if self.journal is not None:
+            data = event.event
+            self.journal.append(code, action, data.get("Index") or 0, data.get("Data"))
+        if self.debug:
+            Domoticz.Debug(f"Got event, action: {action}, code: {code}")
+            Domoticz.Debug(f"{event.event}")
+
+        handler = self.event_handlers.get((code, action)) or self.event_handlers.get((code, None))
+        if handler is None:
+            return
 
-                    if action == "Pulse" and code == "AccessControl":
-                        data = event.get("Data")
-                        command = data.get('Name')
-                        self.handle_lock_command(command)
+        try:
+            handler(event.event)
+        except Exception as ex:
+            exc_type, exc_obj, exc_tb = sys.exc_info()
 
-                    if action == "Start" and code == "ProfileAlarmTransmit":
-                        self.handle_temper_alert(True)
+            Domoticz.Log(f"Failed to handle event, error: {ex}, Line: {exc_tb.tb_lineno}")
 
-                    if action == "Stop" and code == "ProfileAlarmTransmit":
-                        self.handle_temper_alert(False)
+    def handle_back_key_light_event(self, event):
+        self.handle_doorbell_state(event.get("Data").get("State"))
 
-            except Exception as ex:
-                exc_type, exc_obj, exc_tb = sys.exc_info()
+    def handle_access_control_event(self, event):
+        self.handle_lock_command(event.get("Data").get("Name"), event.get("Index") or 0)
 
-                Domoticz.Log(f"Failed to handle event, error: {ex}, Line: {exc_tb.tb_lineno}")
+    def handle_profile_alarm_transmit_event(self, event):
+        self.handle_temper_alert(event.get("Action") == "Start")
 
     def handle_doorbell_state(self, doorbell_state):
         Domoticz.Log(f"Got BackKeyLight-event, State: {doorbell_state}")
-        if doorbell_state == 1:
-            self.update_device(1, 1, "On")
-            self.update_device(2, 10, str(10))  # On
-        elif doorbell_state == 2:
-            self.update_device(2, 20, str(20))  # Calling
-        elif doorbell_state == 5:
-            self.update_device(2, 30, str(30))  # Connected
-        else:
-            self.update_device(1, 0, "Off")
-            self.update_device(2, 0, str(0))  # Off
+        transitions = self.call.feed(doorbell_state)
+        if not transitions:
+            # Repeated or out of order state; the devices already show the call
+            return
 
-    def handle_lock_command(self, lock_command):
-        Domoticz.Log(f"Got AccessControl-event, Command: {lock_command}")
+        self.doorbell_received = True
+        for call_state, action in transitions:
+            self.handle_call_transition(call_state, action)
+
+    def handle_call_transition(self, call_state, action):
+        if action == CALL_STARTED and self.snapshots is not None:
+            self.take_snapshot()
+        if call_state == CALL_RINGING:
+            self.update_device(UNIT_DOORBELL, 1, "On")
+            self.update_device(UNIT_DOORBELL_ADVANCED, 10, str(10))  # On
+        elif call_state == CALL_CALLING:
+            self.update_device(UNIT_DOORBELL_ADVANCED, 20, str(20))  # Calling
+        elif call_state == CALL_CONNECTED:
+            self.update_device(UNIT_DOORBELL_ADVANCED, 30, str(30))  # Connected
+        else:
+            self.update_device(UNIT_DOORBELL, 0, "Off")
+            self.update_device(UNIT_DOORBELL_ADVANCED, 0, str(0))  # Off
+
+        if action == CALL_ANSWERED:
+            Domoticz.Log(f"Call answered after {self.call.ring_to_answer:.1f} seconds")
+            self.update_device(UNIT_RING_TO_ANSWER, 0, f"{self.call.ring_to_answer:.1f}")
+        elif action == CALL_MISSED:
+            Domoticz.Log(f"Missed call; Missed calls: {self.call.missed_calls} of {self.call.calls}")
+            self.update_device(UNIT_MISSED_CALLS, 0, "1", always_update=True)
+        elif action == CALL_ENDED and self.call.duration is not None:
+            Domoticz.Log(f"Call ended after {self.call.duration:.1f} seconds")
+            self.update_device(UNIT_CALL_DURATION, 0, f"{self.call.duration:.1f}")
+
+    def handle_lock_command(self, lock_command, door_index: int = 0):
+        Domoticz.Log(f"Got AccessControl-event, Command: {lock_command}, Door: {door_index + 1}")
+        door = self.door(door_index)
         if lock_command == "OpenDoor":
-            self.update_device(4, 1, "Unlocked")
-            self.unlock_interval_next = self.unlock_interval + 1
-            if self.hold_time is not None:
-                self.hold_time_date = datetime.now() + timedelta(seconds=self.hold_time)
+            if door.awaiting_event:
+                door.awaiting_event = False
+                door.event_latency = self.scheduler.clock() - door.command_sent
+                door.cancel_event_timer()
+                Domoticz.Log(f"Door {door_index + 1} opened {door.event_latency * 1000:.0f} ms after the open door "
+                             f"command")
+            self.update_device(door.unit, 1, "Unlocked")
+            self.schedule_relock(door)
+            if door.hold_time is not None:
+                door.hold_until = self.scheduler.clock() + door.hold_time
         if lock_command == "CloseDoor":
-            self.update_device(4, 0, "Locked")
-            self.unlock_interval_next = None
+            self.update_device(door.unit, 0, "Locked")
+            door.cancel_relock()
+
+    def door(self, door_index: int) -> DoorState:
+        door = self.doors.get(door_index)
+        if door is None:
+            # Door without configuration (yet); it shares the device of the first door
+            door = self.doors[door_index] = DoorState(door_index, UNIT_DOOR_LOCK + door_index
+                                                      if door_index < MAX_DOORS else UNIT_DOOR_LOCK)
+        return door
 
     def handle_temper_alert(self, temper_state: bool):
         if temper_state:
-            self.update_device(3, 4, "Alert")
+            self.update_device(UNIT_TEMPER_ALARM, 4, "Alert")
         else:
-            self.update_device(3, 0, "No alert")
+            self.update_device(UNIT_TEMPER_ALARM, 0, "No alert")
 
-    @staticmethod
-    def update_device(unit, n_value, s_value, timed_out=0, always_update=False):
-        # Make sure that the Domoticz device still exists (they can be deleted) before updating it
-        if unit in Devices:
-            if Devices[unit].nValue != n_value or Devices[unit].sValue != s_value or Devices[
-                unit].TimedOut != timed_out or always_update:
-                Devices[unit].Update(nValue=n_value, sValue=str(s_value), TimedOut=timed_out)
-                Domoticz.Debug(
-                    "Update " + Devices[unit].Name + ": " + str(n_value) + " - '" + str(s_value) + "' - " + str(timed_out))
+    def update_device(self, unit, n_value, s_value, timed_out=0, always_update=False):
+        self.plugin.update_device(self.unit(unit), n_value, s_value, timed_out, always_update)
+
+    def schedule_keep_alive(self):
+        if self.keep_alive_timer is not None:
+            self.keep_alive_timer.cancel()
+        self.keep_alive_timer = self.scheduler.call_at(self.keep_alive_policy.next_probe(), self.check_keep_alive)
+
+    def check_keep_alive(self):
+        # Received data moves the next probe ahead; the timer is only re-armed when it fires
+        self.keep_alive_timer = None
+        if self.keep_alive_policy.probing:
+            return
+        next_probe = self.keep_alive_policy.next_probe()
+        if next_probe > self.scheduler.clock():
+            self.keep_alive_timer = self.scheduler.call_at(next_probe, self.check_keep_alive)
+        else:
+            self.keep_alive()
 
     def keep_alive(self):
-        if Parameters["Mode6"] == "Debug":
+        if self.debug:
             Domoticz.Log("Sending keep alive to Dahua VTO successfully.")
-        self.keep_alive_interval_next = 3
 
         request_data = {
-            "timeout": self.keep_alive_interval,
+            "timeout": self.keep_alive_policy.interval,
             "action": True
         }
 
-        self.send("global.keepAlive", self.handle_keep_alive, True, request_data)
+        self.send("global.keepAlive", self.handle_keep_alive, True, request_data,
+                  timeout=self.keep_alive_policy.timeout(), on_timeout=self.handle_keep_alive_timeout,
+                  priority=PRIORITY_KEEP_ALIVE)
+        self.keep_alive_policy.on_probe_sent(self.scheduler.clock())
 
     def handle_keep_alive(self, data):
         result = data.get("result")
         if result:
-            if Parameters["Mode6"] == "Debug":
+            if self.debug:
                 Domoticz.Log("Received keep alive from Dahua VTO successfully.")
-            self.keep_alive_interval_next = self.keep_alive_interval
+            self.keep_alive_policy.on_probe_acked(self.scheduler.clock())
+            self.schedule_keep_alive()
         else:
-            Domoticz.Error("Failed to sent keep alive to Dahua VTO; Reconnecting in ~30...")
+            delay = self.schedule_reconnect(FAILURE_NETWORK)
+            Domoticz.Error(f"Failed to sent keep alive to Dahua VTO; Reconnecting in ~{delay:.0f}...")
             self.disconnect()
-            self.connection = None
-            self.keep_alive_interval_next = 30
-            return
+
+    def handle_keep_alive_timeout(self, request: PendingRequest):
+        if self.keep_alive_policy.on_probe_timeout(self.scheduler.clock()):
+            delay = self.schedule_reconnect(FAILURE_NETWORK)
+            Domoticz.Error(f"No keep alive received from Dahua VTO {self.name}; Reconnecting in ~{delay:.0f}...")
+            self.disconnect()
+        elif self.keep_alive_policy.failures == 0:
+            # Other data was received in the meantime, so the VTO is still there
+            self.schedule_keep_alive()
+        else:
+            Domoticz.Error("No keep alive received from Dahua VTO; Resending keep alive.")
+            if self.connection is not None and self.connection.Connected():
+                self.keep_alive()
+
+    def schedule_reconnect(self, failure: str) -> float:
+        if self.reconnect_timer is not None:
+            self.reconnect_timer.cancel()
+        delay = self.reconnect_policy.next_delay(failure, self.scheduler.clock())
+        self.metrics.reconnects += 1
+        self.reconnect_timer = self.scheduler.call_later(delay, self.reconnect)
+        return delay
+
+    def reconnect(self):
+        self.reconnect_timer = None
+        if self.connection is None:
+            self.connect()
 
     def handle_retries(self):
-        if "deviceType" in self.dahua_details and "version" in self.dahua_details and "buildDate" in self.dahua_details and "serialNumber" in self.dahua_details and self.access_control_factory_instance is not None and self.unlock_interval is not None and self.hold_time is not None:
+        if "deviceType" in self.dahua_details and "version" in self.dahua_details and "buildDate" in self.dahua_details and "serialNumber" in self.dahua_details and self.access_control_factory_instance is not None and "accessControl" in self.dahua_details:
             Domoticz.Log("Initialized successfully")
             self.retry_attempts = None
-            self.retry_attempt_interval_next = None
+            self.retry_timer = None
             return
 
         Domoticz.Error("Initialization not completed; Retrying failed calls.")
         self.retry_attempts -= 1
 
-        if "deviceType" not in self.dahua_details:
-            self.data_handlers = {key: val for key, val in self.data_handlers.items() if val != self.handle_device_type}
-            Domoticz.Error("Reloading device type.")
-            self.load_device_type()
-
-        if "version" not in self.dahua_details or "buildDate" not in self.dahua_details:
-            self.data_handlers = {key: val for key, val in self.data_handlers.items() if val != self.handle_version}
-            Domoticz.Error("Reloading version.")
-            self.load_version()
-
-        if "serialNumber" not in self.dahua_details:
-            self.data_handlers = {key: val for key, val in self.data_handlers.items() if val != self.handle_serial_number}
-            Domoticz.Error("Reloading serial number.")
-            self.load_serial_number()
-
-        if self.access_control_factory_instance is None:
-            self.data_handlers = {key: val for key, val in self.data_handlers.items() if
-                                  val != self.handle_access_control_factory_instance}
-            Domoticz.Error("Reloading access control factory instance.")
-            self.load_access_control_factory_instance()
-
-        if self.unlock_interval is None or self.hold_time is None:
-            self.data_handlers = {key: val for key, val in self.data_handlers.items() if val != self.handle_access_control}
-            Domoticz.Error("Reloading access control.")
-            self.load_access_control()
-
-        self.retry_attempt_interval_next = 5
+        with self.batch(self.multicall):
+            if "deviceType" not in self.dahua_details:
+                self.protocol.pending.cancel_method("magicBox.getDeviceType", self.handle_device_type)
+                Domoticz.Error("Reloading device type.")
+                self.load_device_type()
+
+            if "version" not in self.dahua_details or "buildDate" not in self.dahua_details:
+                self.protocol.pending.cancel_method("magicBox.getSoftwareVersion", self.handle_version)
+                Domoticz.Error("Reloading version.")
+                self.load_version()
+
+            if "serialNumber" not in self.dahua_details:
+                self.protocol.pending.cancel_method("configManager.getConfig", self.handle_serial_number)
+                Domoticz.Error("Reloading serial number.")
+                self.load_serial_number()
+
+            if self.access_control_factory_instance is None:
+                self.protocol.pending.cancel_method("accessControl.factory.instance")
+                Domoticz.Error("Reloading access control factory instance.")
+                self.load_access_control_factory_instance()
+
+            # Doors also get a state from door commands and events, so they do not tell the configuration was loaded
+            if "accessControl" not in self.dahua_details:
+                self.protocol.pending.cancel_method("configManager.getConfig", self.handle_access_control)
+                Domoticz.Error("Reloading access control.")
+                self.load_access_control()
+
+        if self.retry_attempts > 0:
+            self.retry_timer = self.scheduler.call_later(self.retry_interval, self.handle_retries)
+        else:
+            self.retry_timer = None
 
     def open_door(self, door_index: int = 0):
-        if self.access_control_factory_instance is not None and (
-                self.hold_time_date is None or self.hold_time_date < datetime.now()):
+        door = self.door(door_index)
+        now = self.scheduler.clock()
+        if self.access_control_factory_instance is not None and (door.hold_until is None or door.hold_until < now):
             Domoticz.Log(
-                "Sending open door command to Dahua VTO with instance: {}".format(self.access_control_factory_instance))
+                "Sending open door command to Dahua VTO with instance: {}, door: {}".format(
+                    self.access_control_factory_instance, door_index + 1))
 
             request_data = {
                 "DoorIndex": door_index,
@@ -456,28 +877,61 @@ class DahuaVTODz:
                 "UserID": "",
             }
 
-            self.send("accessControl.openDoor", self.handle_open_door, True, request_data,
-                      self.access_control_factory_instance)
-        elif self.hold_time_date is not None and self.hold_time_date >= datetime.now():
+            if not self.send("accessControl.openDoor", partial(self.handle_open_door, door), True, request_data,
+                             self.access_control_factory_instance,
+                             on_timeout=partial(self.handle_open_door_timeout, door), priority=PRIORITY_DOOR):
+                return
+
+            door.command_sent = now
+            door.awaiting_event = True
+            door.cancel_event_timer()
+            door.event_timer = self.scheduler.call_later(self.unlock_event_timeout, self.handle_unlock_event_timeout,
+                                                         door)
+            if self.plugin.optimistic_unlock:
+                # Show the door as unlocked right away; the OpenDoor event confirms it, or cancel_unlock undoes it
+                self.update_device(door.unit, 1, "Unlocked")
+        elif door.hold_until is not None and door.hold_until >= now:
             Domoticz.Error(
                 "Not sending open door command to Dahua VTO, because lock is still on-hold")
         else:
-            Domoticz.Log(
-                "Failed sending open door command to Dahua VTO, because missing Access Control Factory Instance")
+            self.hold_door_command(door_index, self.open_door)
 
-    @staticmethod
-    def handle_open_door(data):
+    def handle_open_door(self, door: DoorState, data):
         result = data.get("result")
+        if door.command_sent is not None:
+            door.ack_latency = self.scheduler.clock() - door.command_sent
         if result:
-            Domoticz.Log("Sent open door command to Dahua VTO successfully")
+            Domoticz.Log(f"Sent open door command to Dahua VTO successfully in {door.ack_latency * 1000:.0f} ms")
         else:
             Domoticz.Error("Failed to sent open door command to Dahua VTO")
             Domoticz.Log(f"{data}")
+            self.cancel_unlock(door)
+
+    def handle_open_door_timeout(self, door: DoorState, request: PendingRequest):
+        Domoticz.Error(f"No reply received from Dahua VTO to the open door command for door: {door.index + 1}")
+        self.cancel_unlock(door)
+
+    def handle_unlock_event_timeout(self, door: DoorState):
+        door.event_timer = None
+        Domoticz.Error(f"No OpenDoor event received from Dahua VTO for door: {door.index + 1} within "
+                       f"{self.unlock_event_timeout} seconds")
+        self.cancel_unlock(door)
+
+    def cancel_unlock(self, door: DoorState):
+        # The open door command did not open the door; a later OpenDoor event is not its latency
+        if not door.awaiting_event:
+            return
+        door.awaiting_event = False
+        door.cancel_event_timer()
+        if self.plugin.optimistic_unlock:
+            self.update_device(door.unit, 0, "Locked")
+            door.cancel_relock()
 
     def close_door(self, door_index: int = 0):
         if self.access_control_factory_instance is not None:
             Domoticz.Log(
-                "Sending close door command to Dahua VTO with instance: {}".format(self.access_control_factory_instance))
+                "Sending close door command to Dahua VTO with instance: {}, door: {}".format(
+                    self.access_control_factory_instance, door_index + 1))
 
             request_data = {
                 "DoorIndex": door_index,
@@ -485,165 +939,469 @@ class DahuaVTODz:
                 "UserID": "",
             }
 
-            self.send("accessControl.closeDoor", self.handle_close_door, True, request_data,
-                      self.access_control_factory_instance)
+            self.send("accessControl.closeDoor", partial(self.handle_close_door, self.door(door_index)), True,
+                      request_data, self.access_control_factory_instance, priority=PRIORITY_DOOR)
         else:
-            Domoticz.Log(
-                "Failed sending open door command to Dahua VTO, because missing Access Control Factory Instance")
+            self.hold_door_command(door_index, self.close_door)
+
+    def hold_door_command(self, door_index: int, command: Callable):
+        # Only the last command per door is kept
+        Domoticz.Log(f"Not logged into Dahua VTO {self.name}; Holding door command for door: {door_index + 1}")
+        self.held_door_commands[door_index] = (self.scheduler.clock() + self.door_command_hold, command)
+
+    def send_held_door_commands(self):
+        held_door_commands = self.held_door_commands
+        self.held_door_commands = {}
+        now = self.scheduler.clock()
+        for door_index, (deadline, command) in held_door_commands.items():
+            if deadline < now:
+                Domoticz.Error(f"Dropped door command for door: {door_index + 1}, because it was held for more "
+                               f"than {self.door_command_hold} seconds")
+            else:
+                command(door_index)
 
-    def handle_close_door(self, data):
+    def handle_close_door(self, door: DoorState, data):
         result = data.get("result")
         if result:
             Domoticz.Log("Sent close door command to Dahua VTO successfully")
             # No event is triggered by this, so apply changes locally directly
-            self.update_device(4, 0, "Locked")
-            self.unlock_interval_next = None
+            self.update_device(door.unit, 0, "Locked")
+            door.cancel_relock()
         else:
             Domoticz.Error("Failed to sent close door command to Dahua VTO")
             Domoticz.Log(f"{data}")
 
     def on_message(self, data):
-        if self.prevMessage is not None:
-            if Parameters["Mode6"] == "Debug":
-                Domoticz.Log(f"Previously unparseable message is prepended to new message: {data}")
-            message = self.parse_response(self.prevMessage + data)
-            if message is None:
-                if Parameters["Mode6"] == "Debug":
-                    Domoticz.Error(f"Unparseable data message received: {self.prevMessage}")
-                message = self.parse_response(data)
+        self.handle_events(self.receive(data))
+
+    def receive(self, data, received_at: float = None) -> list:
+        if self.capture is not None:
+            self.capture.write(DIRECTION_IN, data)
+        self.received_at = self.scheduler.clock() if received_at is None else received_at
+        self.metrics.bytes_in += len(data)
+        self.keep_alive_policy.on_received(self.received_at)
+        return self.protocol.receive_data(data)
+
+    def handle_events(self, events: list, generation: int = None):
+        # On the worker thread the lock is taken per event, so a burst of events does not hold up the callbacks on
+        # the plugin thread; the events of a connection that closed in the meantime are dropped
+        lock = self.plugin.lock
+        with self.plugin.deferred_device_updates():
+            for event in events:
+                with lock:
+                    if generation is not None and generation != self.generation:
+                        break
+                    self.handle_protocol_event(event)
+
+        with lock:
+            if self.doorbell_received:
+                # The doorbell devices are updated once all received data is handled; with the worker thread, on the
+                # plugin thread right before this
+                self.doorbell_received = False
+                self.plugin.call_in_plugin_thread(self.observe_doorbell_latency, self.received_at)
+            self.transmit()
+
+    def observe_doorbell_latency(self, received_at: float):
+        self.metrics.doorbell_latency.observe(self.scheduler.clock() - received_at)
+
+    def handle_protocol_event(self, event):
+        self.protocol_event_handlers[type(event)](event)
+
+    def handle_response(self, event: Response):
+        request = event.request
+        if request.single_response and request.sent_at is not None:
+            rtt = self.scheduler.clock() - request.sent_at
+            self.keep_alive_policy.on_response(rtt)
+            self.metrics.observe_rpc(request.method, rtt)
+        request.handler(event.message)
+
+    def handle_request_timed_out(self, event: RequestTimedOut):
+        request = event.request
+        if request.on_timeout is not None:
+            request.on_timeout(request)
         else:
-            message = self.parse_response(data)
+            self.handle_timeout(request)
 
-        if message is None:
-            if self.prevMessage is None:
-                self.prevMessage = data
-            else:
-                self.prevMessage = self.prevMessage + data
+    def handle_unhandled_message(self, event: UnhandledMessage):
+        self.handle_default(event.message)
 
-            if Parameters["Mode6"] == "Debug":
-                Domoticz.Log(f"Unparseable data message (possible partial) received: {data}")
-            return
-
-        self.prevMessage = None
-
-        message_id = message.get("id")
+    @staticmethod
+    def handle_multicall_rejected(event: MulticallRejected):
+        Domoticz.Error("Dahua VTO does not support system.multicall; Falling back to individual calls.")
+        Domoticz.Log(f"{event.message}")
 
-        handler: Callable = self.data_handlers.get(message_id, self.handle_default)
-        handler(message)
+    @staticmethod
+    def handle_invalid_frame(event: InvalidFrame):
+        Domoticz.Log(f"Failed to read data: {event.payload}, error: {event.error}")
 
-        if message_id not in self.keep_data_handlers:
-            self.data_handlers.pop(message_id, None)
+    @staticmethod
+    def handle_stream_resynced(event: StreamResynced):
+        Domoticz.Error(f"Skipped garbage in data received from Dahua VTO; Dropped bytes: {event.dropped_bytes}"
+                       f", resyncs: {event.resyncs}")
 
     @staticmethod
     def handle_default(data):
         Domoticz.Log(f"Data received without handler: {data}")
 
+    @staticmethod
+    def handle_timeout(request: PendingRequest):
+        Domoticz.Error(f"No response received from Dahua VTO for {request.method} (id: {request.request_id})")
+
     def on_disconnect(self):
-        Domoticz.Error("Got disconnected from Dahua VTO; Reconnecting in ~30...")
+        # A reconnect is already scheduled when the plugin closed the connection itself
+        if self.reconnect_timer is None:
+            delay = self.schedule_reconnect(FAILURE_NETWORK)
+            Domoticz.Error(f"Got disconnected from Dahua VTO {self.name}; Reconnecting in ~{delay:.0f}...")
+        else:
+            Domoticz.Log(f"Disconnected from Dahua VTO {self.name}")
+        if self.capture is not None:
+            self.capture.write(DIRECTION_DISCONNECT)
         self.connection = None
+        self.generation += 1
+        self.protocol.connection_lost()
         self.reset_params()
-        self.keep_alive_interval_next = 30
-        self.update_device(1, Devices[1].nValue, Devices[1].sValue, 1)
-        self.update_device(2, Devices[2].nValue, Devices[2].sValue, 1)
-        self.update_device(3, Devices[3].nValue, Devices[3].sValue, 1)
-        self.update_device(4, Devices[4].nValue, Devices[4].sValue, 1)
+        self.set_timed_out(1)
 
-    def on_heartbeat(self):
-        if self.connection is not None and self.connection.Connected() and self.retry_attempts is not None and self.retry_attempts > 0 and self.retry_attempt_interval_next is not None:
-            self.retry_attempt_interval_next -= 1
-            if self.retry_attempt_interval_next <= 0:
-                self.handle_retries()
-
-        if self.connection is not None and self.connection.Connected() and self.keep_alive_interval_next is not None:
-            self.keep_alive_interval_next -= 1
-            if self.keep_alive_interval_next <= 0:
-                self.keep_alive()
-        elif self.keep_alive_interval_next is not None and self.keep_alive_interval_next > 0:
-            self.keep_alive_interval_next -= 1
-            if self.keep_alive_interval_next <= 0:
-                self.keep_alive_interval_next = None
-                self.connect()
-
-        if self.unlock_interval_next is not None:
-            self.unlock_interval_next -= 1
-            if self.unlock_interval_next <= 0:
-                self.unlock_interval_next = None
-                self.update_device(4, 0, "Locked")
+    def on_heartbeat(self, now: float):
+        for event in self.protocol.expire(now):
+            self.handle_protocol_event(event)
+
+        self.transmit()
+        if self.capture is not None:
+            self.capture.flush()
+        if self.snapshots is not None:
+            self.handle_snapshot_results()
+
+    def schedule_relock(self, door: DoorState):
+        door.cancel_relock()
+        if door.unlock_interval is not None:
+            door.relock_timer = self.scheduler.call_later(door.unlock_interval + 1, self.relock, door)
+
+    def relock(self, door: DoorState):
+        # The VTO does not send an event when the lock closes again after the unlock interval
+        door.relock_timer = None
+        self.update_device(door.unit, 0, "Locked")
 
     def on_command(self, unit, command, level, color):
-        Domoticz.Debug("onCommand: " + command + ", level (" + str(level) + ") Color:" + color)
-        if unit == 4 and command == "On":
-            self.open_door()
+        if UNIT_DOOR_LOCK <= unit < UNIT_DOOR_LOCK + MAX_DOORS and command == "On":
+            self.open_door(unit - UNIT_DOOR_LOCK)
 
-        if unit == 4 and command == "Off":
-            self.close_door()
+        if UNIT_DOOR_LOCK <= unit < UNIT_DOOR_LOCK + MAX_DOORS and command == "Off":
+            self.close_door(unit - UNIT_DOOR_LOCK)
 
     def reset_params(self):
         self.retry_attempts = 3
-        self.retry_attempt_interval_next = 5
-        self.request_id = 1
-        self.session_id = 0
-        self.realm = None
-        self.random = None
         self.access_control_factory_instance = None
-        self.unlock_interval = None
-        self.unlock_interval_next = None
-        self.keep_alive_interval = None
-        self.keep_alive_interval_next = None
-        self.data_handlers = {}
-        self.keep_data_handlers = []
         self.dahua_details = {}
-        self.hold_time = 0
-        self.hold_time_date = None
-        self.prevMessage = None
+        for door in self.doors.values():
+            door.cancel_relock()
+            door.cancel_event_timer()
+        self.doors = {}
+        for timer in (self.retry_timer, self.keep_alive_timer, self.metadata_timer):
+            if timer is not None:
+                timer.cancel()
+        self.retry_timer = None
+        self.keep_alive_timer = None
+        self.metadata_timer = None
+        self.cached_metadata = None
+        self.call.reset()
+        self.restore_metadata()
 
-    @staticmethod
-    def parse_response(response):
-        result = None
 
-        try:
-            response_parts = str(response).split("\\x00")
-            for responsePart in response_parts:
-                if responsePart.startswith("{"):
-                    end = responsePart.rindex("}") + 1
-                    message = responsePart[0:end]
+class DahuaVTODz:
+    enabled = False
+    heartbeat_interval = 1
+    max_buffer_size = 65536
+    multicall = False
+    keep_alive_policy = "adaptive"
+    keep_alive_idle = None
+    reconnect_max = 300
+    max_in_flight = 4
+    optimistic_unlock = False
+    capture = False
+    # Missed calls, ring to answer time and call duration devices
+    call_devices = False
+    # Interval in seconds of the metrics log line and devices; 0 disables them
+    metrics_interval = 0
+    metrics_devices = False
+    profile_interval = 300
+    profile_files = 5
+    worker = False
+    # Chunks of received data waiting for the worker thread; when the queue is full onMessage waits for room
+    worker_queue = 1000
+    # Seconds onMessage waits for an idle worker thread to handle the data, so the devices are updated right away
+    # instead of on the next callback. A busy worker thread is not waited for.
+    worker_wait = 0.01
+    journal = False
+    # Megabytes
+    journal_size = 4
+    snapshot = False
+    snapshot_port = 80
+    snapshot_channel = 1
+    snapshot_files = 50
+    # Megabytes
+    snapshot_size = 50
 
-                    result = json.loads(message)
+    def __init__(self):
+        self.options = {}
+        self.debug = False
+        self.deferred_updates = None
+        self.history_units = set()
+        self.counter_units = set()
+        self.extra_event_codes = []
+        self.scheduler = TimerScheduler()
+        self.metadata_cache = None
+        self.endpoints = []
+        self.endpoints_by_connection = {}
+        self.profiler = None
+        # Without the worker thread the lock is not needed
+        self.lock = nullcontext()
+        self.received = None
+        self.worker_thread = None
+        self.worker_idle = threading.Event()
+        self.plugin_thread = None
+        self.plugin_calls = deque()
 
-        except Exception as e:
-            exc_type, exc_obj, exc_tb = sys.exc_info()
+    def on_start(self):
+        self.debug = Parameters["Mode6"] == "Debug"
+        if self.debug:
+            Domoticz.Debugging(1)
+        dump_config_to_log()
+        self.options = parse_options(Parameters.get("Mode2", ""))
+        self.extra_event_codes = [code.strip() for code in Parameters.get("Mode1", "").split(",") if code.strip()]
+        self.max_buffer_size = option_int(self.options, "buffer_size", self.max_buffer_size)
+        self.multicall = option_bool(self.options, "multicall", self.multicall)
+        self.heartbeat_interval = min(max(option_int(self.options, "heartbeat", self.heartbeat_interval), 1), 30)
+        self.keep_alive_policy = self.options.get("keep_alive", self.keep_alive_policy)
+        if self.keep_alive_policy not in KEEP_ALIVE_POLICIES:
+            Domoticz.Error(f"Unknown keep alive policy: {self.keep_alive_policy}; Using adaptive")
+            self.keep_alive_policy = "adaptive"
+        self.keep_alive_idle = option_int(self.options, "keep_alive_idle", self.keep_alive_idle)
+        self.reconnect_max = max(option_int(self.options, "reconnect_max", self.reconnect_max), 1)
+        self.max_in_flight = max(option_int(self.options, "max_in_flight", self.max_in_flight), 1)
+        self.optimistic_unlock = option_bool(self.options, "optimistic_unlock", self.optimistic_unlock)
+        self.capture = option_bool(self.options, "capture", self.capture)
+        self.call_devices = option_bool(self.options, "call_devices", self.call_devices)
+        self.journal = option_bool(self.options, "journal", self.journal)
+        self.journal_size = max(option_int(self.options, "journal_size", self.journal_size), 1)
+        self.snapshot = option_bool(self.options, "snapshot", self.snapshot)
+        self.snapshot_port = option_int(self.options, "snapshot_port", self.snapshot_port)
+        self.snapshot_channel = option_int(self.options, "snapshot_channel", self.snapshot_channel)
+        self.snapshot_files = max(option_int(self.options, "snapshot_files", self.snapshot_files), 1)
+        self.snapshot_size = max(option_int(self.options, "snapshot_size", self.snapshot_size), 1)
+        self.metrics_interval = max(option_int(self.options, "metrics", self.metrics_interval), 0)
+        self.metrics_devices = option_bool(self.options, "metrics_devices", self.metrics_devices)
+        if self.metrics_devices and not self.metrics_interval:
+            self.metrics_interval = 300
+        self.worker = option_bool(self.options, "worker", self.worker)
+        if Parameters["Mode6"] == "Profile":
+            self.start_profiler()
+        if option_bool(self.options, "metadata_cache", True):
+            self.metadata_cache = MetadataCache(os.path.join(Parameters["HomeFolder"], "metadata_cache.json"))
+            self.metadata_cache.load()
+
+        endpoints = parse_endpoints(Parameters["Address"], Parameters["Port"], Parameters["Username"],
+                                    Parameters["Password"])
+        for index, (host, port, username, password) in enumerate(endpoints[:MAX_ENDPOINTS]):
+            endpoint = VTOEndpoint(self, index, host, port, username, password)
+            self.endpoints.append(endpoint)
+            self.endpoints_by_connection[endpoint.connection_name] = endpoint
+        if len(endpoints) > MAX_ENDPOINTS:
+            Domoticz.Error(f"Only the first {MAX_ENDPOINTS} Dahua VTOs are used")
+
+        # History units are configured per VTO, relative to its first unit
+        history_units = {int(unit) for unit in self.options.get("history_units", "").split(",") if unit.strip().isdigit()}
+        self.history_units = {endpoint.unit(unit) for endpoint in self.endpoints for unit in history_units}
+        self.counter_units = {endpoint.unit(unit) for endpoint in self.endpoints for unit in COUNTER_UNITS}
+
+        for endpoint in self.endpoints:
+            endpoint.setup_devices()
+            if self.call_devices:
+                endpoint.setup_call_devices()
+            if self.metrics_devices:
+                endpoint.setup_metrics_devices()
+            if self.metrics_interval:
+                endpoint.start_metrics(self.metrics_interval)
+            if self.capture:
+                endpoint.start_capture(Parameters["HomeFolder"])
+            if self.journal:
+                endpoint.open_journal(Parameters["HomeFolder"])
+            if self.snapshot:
+                endpoint.start_snapshots(Parameters["HomeFolder"])
+        if self.worker:
+            self.start_worker()
+        for endpoint in self.endpoints:
+            endpoint.connect()
+        Domoticz.Heartbeat(self.heartbeat_interval)
+
+    def start_profiler(self):
+        # The callbacks are replaced on this instance only, so they cost nothing extra unless profiling
+        self.profile_interval = max(option_int(self.options, "profile_interval", self.profile_interval), 1)
+        self.profile_files = max(option_int(self.options, "profile_files", self.profile_files), 1)
+        self.profiler = CallbackProfiler(Parameters["HomeFolder"], self.profile_interval, self.profile_files,
+                                         self.scheduler.clock, self.handle_profile_error)
+        self.on_message = self.profiler.wrap("onMessage", self.on_message)
+        self.on_heartbeat = self.profiler.wrap("onHeartbeat", self.on_heartbeat)
+        self.on_command = self.profiler.wrap("onCommand", self.on_command)
+        Domoticz.Log(f"Profiling the plugin; Writing stats to {self.profiler.path('txt')} "
+                     f"every {self.profile_interval} seconds")
+
+    def start_worker(self):
+        # Received data is decoded and handled on the worker thread. Everything else that touches the endpoints runs
+        # under the lock; Devices are only created and updated on the plugin thread. Domoticz queues Connection.Send
+        # and Disconnect for its own I/O thread, so the worker thread calls those directly.
+        self.lock = threading.RLock()
+        self.received = queue.Queue(self.worker_queue)
+        self.plugin_thread = threading.get_ident()
+        self.worker_thread = threading.Thread(target=self.run_worker, name="DahuaVTO worker", daemon=True)
+        self.worker_idle.set()
+        self.worker_thread.start()
+        Domoticz.Log("Handling the data received from the Dahua VTOs on a worker thread")
+
+    def stop_worker(self):
+        if self.worker_thread is not None:
+            self.received.put(None)
+            self.worker_thread.join(5)
+            self.worker_thread = None
+            self.run_plugin_calls()
+
+    def run_worker(self):
+        while True:
+            item = self.received.get()
+            if item is None:
+                break
+
+            endpoint, generation, received_at, data = item
+            try:
+                with self.lock:
+                    # Data of a connection that closed in the meantime is dropped
+                    events = endpoint.receive(data, received_at) if endpoint.generation == generation else []
+                endpoint.handle_events(events, generation)
+            except Exception as ex:
+                Domoticz.Error(f"Failed to handle data of Dahua VTO {endpoint.name}, error: {ex}")
+                Domoticz.Log(traceback.format_exc())
+            if self.received.empty():
+                self.worker_idle.set()
 
-            Domoticz.Log(f"Failed to read data: {response}, error: {e}, Line: {exc_tb.tb_lineno}")
+    def in_plugin_thread(self) -> bool:
+        return self.plugin_thread is None or threading.get_ident() == self.plugin_thread
 
-        return result
+    def call_in_plugin_thread(self, func: Callable, *args):
+        if self.in_plugin_thread():
+            func(*args)
+        else:
+            self.plugin_calls.append(partial(func, *args))
+
+    def run_plugin_calls(self):
+        # Runs the calls the worker thread left for the plugin thread, in order. They only touch Devices and the
+        # metrics of the plugin thread, so they do not wait for the lock while the worker thread handles data.
+        while self.plugin_calls:
+            self.plugin_calls.popleft()()
+
+    def on_stop(self):
+        self.stop_worker()
+        for endpoint in self.endpoints:
+            endpoint.stop_capture()
+            endpoint.close_journal()
+            # Domoticz requires every thread of the plugin to be stopped
+            endpoint.stop_snapshots()
+        if self.profiler is not None:
+            self.profiler.write()
 
     @staticmethod
-    def convert_message(data):
-        message_data = json.dumps(data, indent=4)
-
-        header = struct.pack(">L", 0x20000000)
-        header += struct.pack(">L", 0x44484950)
-        header += struct.pack(">d", 0)
-        header += struct.pack("<L", len(message_data))
-        header += struct.pack("<L", 0)
-        header += struct.pack("<L", len(message_data))
-        header += struct.pack("<L", 0)
+    def handle_profile_error(error: OSError):
+        Domoticz.Error(f"Failed to write profile: {error}")
+
+    def endpoint(self, connection):
+        return self.endpoints_by_connection.get(connection.Name)
+
+    def on_connect(self, connection, status, description):
+        endpoint = self.endpoint(connection)
+        if endpoint is not None:
+            with self.lock:
+                endpoint.on_connect(status, description)
+        self.run_plugin_calls()
+
+    def on_message(self, connection, data):
+        endpoint = self.endpoint(connection)
+        if endpoint is None:
+            return
+        if self.worker_thread is None:
+            endpoint.on_message(data)
+            return
 
-        message = header + message_data.encode("utf-8")
+        idle = self.worker_idle.is_set()
+        if idle:
+            self.worker_idle.clear()
+        self.received.put((endpoint, endpoint.generation, self.scheduler.clock(), data))
+        if idle:
+            self.worker_idle.wait(self.worker_wait)
+        self.run_plugin_calls()
+
+    def on_disconnect(self, connection):
+        endpoint = self.endpoint(connection)
+        if endpoint is not None:
+            with self.lock:
+                endpoint.on_disconnect()
+        self.run_plugin_calls()
 
-        return message
+    def on_heartbeat(self):
+        self.run_plugin_calls()
+        with self.lock:
+            now = self.scheduler.clock()
+            for endpoint in self.endpoints:
+                endpoint.on_heartbeat(now)
 
-    @staticmethod
-    def hash_password(random, realm, username, password):
-        password_str = f"{username}:{realm}:{password}"
-        password_bytes = password_str.encode('utf-8')
-        password_hash = hashlib.md5(password_bytes).hexdigest().upper()
+            self.scheduler.run_due(now)
 
-        random_str = f"{username}:{random}:{password_hash}"
-        random_bytes = random_str.encode('utf-8')
-        random_hash = hashlib.md5(random_bytes).hexdigest().upper()
+    def on_command(self, unit, command, level, color):
+        Domoticz.Debug("onCommand: " + command + ", level (" + str(level) + ") Color:" + color)
+        index = (unit - 1) // UNITS_PER_ENDPOINT
+        if index < len(self.endpoints):
+            with self.lock:
+                self.endpoints[index].on_command(unit - index * UNITS_PER_ENDPOINT, command, level, color)
+        self.run_plugin_calls()
+
+    def update_device(self, unit, n_value, s_value, timed_out=0, always_update=False):
+        # With the worker thread, only the worker thread defers updates
+        if self.deferred_updates is None or threading.get_ident() == self.plugin_thread:
+            self.apply_device_update(unit, n_value, s_value, timed_out, always_update)
+        elif unit in self.history_units or unit in self.counter_units or unit not in self.deferred_updates:
+            self.deferred_updates.setdefault(unit, []).append((n_value, s_value, timed_out, always_update))
+        else:
+            # Only the final state of the unit is written to Domoticz
+            always_update = always_update or self.deferred_updates[unit][-1][3]
+            self.deferred_updates[unit][-1] = (n_value, s_value, timed_out, always_update)
+
+    @contextmanager
+    def deferred_device_updates(self):
+        if self.deferred_updates is not None:
+            yield
+            return
 
-        return random_hash
+        self.deferred_updates = {}
+        try:
+            yield
+        finally:
+            deferred_updates = self.deferred_updates
+            self.deferred_updates = None
+            for unit, updates in deferred_updates.items():
+                for update in updates:
+                    self.apply_device_update(unit, *update)
+
+    def apply_device_update(self, unit, n_value, s_value, timed_out=0, always_update=False):
+        if not self.in_plugin_thread():
+            self.plugin_calls.append(partial(self.apply_device_update, unit, n_value, s_value, timed_out,
+                                             always_update))
+            return
+        # Make sure that the Domoticz device still exists (they can be deleted) before updating it
+        if unit in Devices:
+            if Devices[unit].nValue != n_value or Devices[unit].sValue != s_value or Devices[
+                unit].TimedOut != timed_out or always_update:
+                Devices[unit].Update(nValue=n_value, sValue=str(s_value), TimedOut=timed_out)
+                if self.debug:
+                    Domoticz.Debug(
+                        "Update " + Devices[unit].Name + ": " + str(n_value) + " - '" + str(s_value) + "' - " + str(timed_out))
 
 
 _plugin = DahuaVTODz()
@@ -654,20 +1412,25 @@ def onStart():
     global _plugin
     _plugin.on_start()
 
-# noinspection PyPep8Naming PyUnusedLocal
+# noinspection PyPep8Naming
+def onStop():
+    global _plugin
+    _plugin.on_stop()
+
+# noinspection PyPep8Naming
 def onConnect(Connection, Status, Description):
     global _plugin
-    _plugin.on_connect(Status, Description)
+    _plugin.on_connect(Connection, Status, Description)
 
 # noinspection PyPep8Naming
 def onMessage(Connection, Data):
     global _plugin
-    _plugin.on_message(Data)
+    _plugin.on_message(Connection, Data)
 
-# noinspection PyPep8Naming PyUnusedLocal
+# noinspection PyPep8Naming
 def onDisconnect(Connection):
     global _plugin
-    _plugin.on_disconnect()
+    _plugin.on_disconnect(Connection)
 
 # noinspection PyPep8Naming
 def onHeartbeat():
@@ -683,6 +1446,47 @@ def onCommand(Unit, Command, Level, Color):
 
 
 # Generic helper functions
+def parse_options(value: str) -> dict:
+    # Options are written as "key=value;flag;key=value"
+    options = {}
+    for option in value.split(";"):
+        key, _, option_value = option.partition("=")
+        key = key.strip().lower()
+        if key:
+            options[key] = option_value.strip() if option_value else "true"
+    return options
+
+
+def parse_endpoints(addresses: str, default_port: str, default_username: str, default_password: str) -> list:
+    # Addresses are written as "[username:password@]host[:port]" and separated by commas
+    endpoints = []
+    for address in addresses.split(","):
+        credentials, _, address = address.strip().rpartition("@")
+        if not address:
+            continue
+
+        username, password = default_username, default_password
+        if credentials:
+            username, _, password = credentials.partition(":")
+
+        host, _, port = address.partition(":")
+        endpoints.append((host, int(port or default_port), username, password))
+    return endpoints
+
+
+def option_int(options: dict, key: str, default: int = None):
+    try:
+        return int(options[key])
+    except (KeyError, ValueError):
+        return default
+
+
+def option_bool(options: dict, key: str, default: bool = False):
+    if key not in options:
+        return default
+    return options[key].lower() in ("1", "true", "yes", "on")
+
+
 def dump_config_to_log():
     for x in Parameters:
         if Parameters[x] != "":
@@ -0,0 +1,63 @@
+import unittest
+
+from dahua_vto import (CALL_ANSWERED, CALL_CALLING, CALL_CONNECTED, CALL_ENDED, CALL_IDLE, CALL_MISSED, CALL_RINGING,
+                       CALL_STARTED, CallStateMachine)
+
+
+class CallStateMachineTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.call = CallStateMachine(lambda: self.now)
+
+    def test_answered_call(self):
+        self.assertEqual(self.call.feed(1), [(CALL_RINGING, CALL_STARTED)])
+        self.now = 2.0
+        self.assertEqual(self.call.feed(2), [(CALL_CALLING, None)])
+        self.now = 4.0
+        self.assertEqual(self.call.feed(5), [(CALL_CONNECTED, CALL_ANSWERED)])
+        self.now = 34.0
+        self.assertEqual(self.call.feed(0), [(CALL_IDLE, CALL_ENDED)])
+        self.assertEqual(self.call.ring_to_answer, 4.0)
+        self.assertEqual(self.call.duration, 30.0)
+
+    def test_missed_call(self):
+        self.call.feed(1)
+        self.assertEqual(self.call.feed(0), [(CALL_IDLE, CALL_MISSED)])
+        self.assertEqual((self.call.calls, self.call.missed_calls), (1, 1))
+
+    def test_ignored_states(self):
+        self.assertEqual(self.call.feed(0), [])
+        self.call.feed(1)
+        self.call.feed(5)
+        self.assertEqual(self.call.feed(5), [])
+        self.assertEqual(self.call.feed(2), [])
+        self.assertEqual(self.call.state, CALL_CONNECTED)
+
+    def test_ringing_after_lost_hang_up(self):
+        self.call.feed(1)
+        self.now = 2.0
+        self.call.feed(5)
+        self.now = 12.0
+        self.assertEqual(self.call.feed(1), [(CALL_IDLE, CALL_ENDED), (CALL_RINGING, CALL_STARTED)])
+        self.assertEqual(self.call.duration, 10.0)
+        self.call.feed(2)
+        self.assertEqual(self.call.feed(1), [(CALL_IDLE, CALL_MISSED), (CALL_RINGING, CALL_STARTED)])
+        self.assertEqual((self.call.calls, self.call.missed_calls), (3, 1))
+
+    def test_repeated_ringing(self):
+        self.call.feed(1)
+        self.assertEqual(self.call.feed(1), [])
+        self.assertEqual(self.call.state, CALL_RINGING)
+        self.assertEqual((self.call.calls, self.call.missed_calls), (1, 0))
+
+    def test_reset(self):
+        self.call.feed(1)
+        self.call.feed(5)
+        self.call.reset()
+        self.assertEqual(self.call.state, CALL_IDLE)
+        self.assertEqual(self.call.feed(1), [(CALL_RINGING, CALL_STARTED)])
+        self.assertEqual(self.call.calls, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
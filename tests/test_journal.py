@@ -0,0 +1,64 @@
+import os
+import tempfile
+import unittest
+
+from dahua_vto import EventJournal
+
+
+class EventJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, "journal.bin")
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_append_and_query(self):
+        journal = EventJournal(self.path)
+        for second in range(10):
+            journal.append("BackKeyLight" if second % 2 else "AccessControl", "Pulse", 0, {"second": second},
+                           timestamp=1000.0 + second)
+        events = list(journal.query(1003, 1006))
+        self.assertEqual([event.data["second"] for event in events], [3, 4, 5, 6])
+        events = list(journal.query(codes=["BackKeyLight"]))
+        self.assertEqual([event.sequence for event in events], [1, 3, 5, 7, 9])
+        journal.close()
+
+    def test_wraparound(self):
+        journal = EventJournal(self.path, size=65536, index_slots=16)
+        count = 5000
+        for number in range(count):
+            journal.append("BackKeyLight", "Pulse", number % 3, {"number": number, "pad": "x" * (number % 50)},
+                           timestamp=float(number))
+        events = list(journal.query())
+        # The oldest events were overwritten; the rest are complete and in order
+        self.assertLess(len(events), count)
+        self.assertEqual(events[-1].sequence, count - 1)
+        self.assertEqual([event.sequence for event in events], list(range(events[0].sequence, count)))
+        self.assertEqual([event.data["number"] for event in events], [event.sequence for event in events])
+        self.assertEqual(len(journal), len(events))
+
+        start = events[len(events) // 2].timestamp
+        self.assertEqual([event.timestamp for event in journal.query(start, start + 9)],
+                         [start + offset for offset in range(10)])
+        journal.close()
+
+        journal = EventJournal(self.path)
+        self.assertEqual([event.sequence for event in journal.query()], [event.sequence for event in events])
+        self.assertEqual(journal.append("BackKeyLight", "Pulse"), count)
+        journal.close()
+
+    def test_missing_journal_without_create(self):
+        with self.assertRaises(FileNotFoundError):
+            EventJournal(self.path, create=False)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_not_a_journal(self):
+        with open(self.path, "wb") as file:
+            file.write(b"not a journal")
+        with self.assertRaises(ValueError):
+            EventJournal(self.path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,219 @@
+import unittest
+
+from dahua_vto import DHIPFrameDecoder, fake_domoticz
+from dahua_vto.fake_vto import FakeVTO, FakeVTOSession
+from dahua_vto.replay import load_plugin
+
+plugin_module = load_plugin()
+
+
+class Transport:
+    # Collects the data the fake VTO session writes, until it is delivered to the plugin
+    def __init__(self):
+        self.written = []
+
+    def write(self, data: bytes):
+        self.written.append(data)
+
+    def close(self):
+        pass
+
+
+class PluginTest(unittest.TestCase):
+    # The plugin runs on the fake Domoticz module with a clock of its own, and talks to a fake VTO session over the
+    # fake connection: what the plugin sends is taken from the connection and answered by the session
+    options = "metadata_cache=off"
+
+    def setUp(self):
+        fake_domoticz.reset()
+        fake_domoticz.Parameters.update({"Address": "127.0.0.1", "Port": "5000", "Username": "admin",
+                                         "Password": "", "Mode1": "", "Mode2": self.options, "Mode6": "Normal",
+                                         "HomeFolder": ""})
+        self.now = 1000.0
+        self.plugin = plugin_module.DahuaVTODz()
+        self.plugin.scheduler.clock = lambda: self.now
+        self.plugin.on_start()
+        self.endpoint = self.plugin.endpoints[0]
+        self.vto = FakeVTO(doors=2)
+        self.session = None
+
+    def connect(self, hold=()):
+        # Connects and logs in; returns the requests for the held methods, which are left unanswered
+        self.session = FakeVTOSession(self.vto)
+        self.session.connection_made(Transport())
+        self.plugin.on_connect(self.endpoint.connection, 0, "")
+        return self.exchange(hold)
+
+    def exchange(self, hold=()) -> list:
+        # Lets the session answer the requests of the plugin, until the plugin has nothing more to send
+        held = []
+        while True:
+            requests = self.sent()
+            if not requests:
+                return held
+            for request in requests:
+                if request.get("method") in hold:
+                    held.append(request)
+                else:
+                    self.session.handle_request(request)
+            self.deliver()
+
+    def sent(self) -> list:
+        connection = self.endpoint.connection
+        if connection is None:
+            return []
+        data = b"".join(connection.sent)
+        connection.sent.clear()
+        return DHIPFrameDecoder().feed(data)
+
+    def deliver(self):
+        data = b"".join(self.session.transport.written)
+        self.session.transport.written.clear()
+        if data:
+            self.plugin.on_message(self.endpoint.connection, data)
+
+    def send_events(self, events: list):
+        self.session.send_events(events)
+        self.deliver()
+
+    def doorbell(self, *states):
+        self.send_events([{"Code": "BackKeyLight", "Action": "Pulse", "Index": 0, "Data": {"State": state}}
+                          for state in states])
+
+    def advance(self, seconds: float):
+        self.now += seconds
+        self.plugin.scheduler.run_due(self.now)
+
+    def device(self, unit: int):
+        return fake_domoticz.Devices[unit].nValue
+
+
+class LoginTest(PluginTest):
+    def test_login(self):
+        self.connect()
+        self.assertTrue(self.endpoint.protocol.logged_in)
+        self.assertTrue(self.endpoint.attached_to_events)
+        self.assertEqual(self.endpoint.access_control_factory_instance, 1001)
+        self.assertEqual(self.endpoint.dahua_details["deviceType"], "VTO2202F-P")
+        self.assertEqual(sorted(self.endpoint.doors), [0, 1])
+
+    def test_login_failed(self):
+        self.vto.password = "secret"
+        self.connect()
+        self.assertFalse(self.endpoint.protocol.logged_in)
+        self.assertIsNone(self.endpoint.connection)
+        self.assertIsNotNone(self.endpoint.reconnect_timer)
+
+
+class DoorbellTest(PluginTest):
+    def test_ringing_after_reconnect(self):
+        self.connect()
+        self.doorbell(1, 5)
+        self.plugin.on_disconnect(self.endpoint.connection)
+        self.advance(self.endpoint.reconnect_timer.deadline - self.now)
+        self.connect()
+        self.doorbell(0)
+        self.assertEqual(self.device(1), 1)
+        self.doorbell(1)
+        self.assertEqual((self.device(1), self.device(2)), (1, 10))
+
+    def test_ringing_after_lost_hang_up(self):
+        self.connect()
+        self.doorbell(1, 5)
+        self.doorbell(1)
+        self.assertEqual(self.device(2), 10)
+        self.assertEqual(self.endpoint.call.calls, 2)
+
+    def test_repeated_ringing(self):
+        self.connect()
+        self.doorbell(1, 1, 0)
+        self.assertEqual(self.endpoint.call.missed_calls, 1)
+        self.assertEqual(self.device(1), 0)
+
+
+class CallDevicesTest(PluginTest):
+    options = "metadata_cache=off;call_devices"
+
+    def test_missed_calls_in_one_frame(self):
+        self.connect()
+        updates = []
+        fake_domoticz.Devices[8].Update = lambda **kwargs: updates.append(kwargs["sValue"])
+        self.doorbell(1, 0, 1, 0)
+        self.assertEqual(updates, ["1", "1"])
+
+
+class RetriesTest(PluginTest):
+    def test_door_event_does_not_complete_initialization(self):
+        for request in self.connect(hold=("configManager.getConfig",)):
+            if request["params"]["name"] == "T2UServer":
+                self.session.handle_request(request)
+        self.deliver()
+        # The door gets a state before the access control configuration is loaded
+        self.send_events([self.session.access_control_event(1)])
+        self.assertIn(1, self.endpoint.doors)
+        self.advance(self.endpoint.retry_interval)
+        self.assertEqual([request["params"]["name"] for request in self.sent()], ["AccessControl"])
+        self.assertIsNotNone(self.endpoint.retry_timer)
+
+
+class OpenDoorTest(PluginTest):
+    def open_door(self, result=True):
+        # The VTO acknowledges the door command; the OpenDoor event is sent by the test
+        self.connect()
+        self.plugin.on_command(4, "On", 0, "")
+        request, = self.sent()
+        self.assertEqual(request["method"], "accessControl.openDoor")
+        self.session.reply(request, result)
+        self.deliver()
+        return self.endpoint.door(0)
+
+    def test_event_latency(self):
+        door = self.open_door()
+        self.now += 0.25
+        self.send_events([self.session.access_control_event(0)])
+        self.assertEqual(door.event_latency, 0.25)
+        self.assertEqual(self.device(4), 1)
+
+    def test_held_after_disconnect(self):
+        self.connect()
+        connection = self.endpoint.connection
+        self.advance(self.vto.keep_alive_interval)
+        request, = self.sent()
+        self.assertEqual(request["method"], "global.keepAlive")
+        self.session.reply(request, False)
+        self.deliver()
+        self.assertIsNone(self.endpoint.connection)
+
+        self.plugin.on_command(4, "On", 0, "")
+        self.assertIn(0, self.endpoint.held_door_commands)
+        self.plugin.on_disconnect(connection)
+        self.advance(self.endpoint.reconnect_timer.deadline - self.now)
+        request, = self.connect(hold=("accessControl.openDoor",))
+        self.assertEqual(request["params"]["DoorIndex"], 0)
+        self.assertEqual(self.endpoint.held_door_commands, {})
+
+    def test_no_open_door_event(self):
+        door = self.open_door()
+        self.advance(self.endpoint.unlock_event_timeout)
+        self.assertFalse(door.awaiting_event)
+        self.advance(30)
+        self.send_events([self.session.access_control_event(0)])
+        self.assertIsNone(door.event_latency)
+
+
+class OptimisticUnlockTest(OpenDoorTest):
+    options = "metadata_cache=off;optimistic_unlock"
+
+    def test_rollback(self):
+        self.open_door()
+        self.assertEqual(self.device(4), 1)
+        self.advance(self.endpoint.unlock_event_timeout)
+        self.assertEqual(self.device(4), 0)
+
+    def test_rejected(self):
+        self.open_door(False)
+        self.assertEqual(self.device(4), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
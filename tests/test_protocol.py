@@ -0,0 +1,124 @@
+import unittest
+
+from dahua_vto import (DHIP_HEADER, DHIP_MAGIC, DHIPFrameDecoder, MulticallRejected, PendingRequest, PendingRequests,
+                       RequestTimedOut, Response, VTOProtocol, encode_message)
+
+
+class DHIPFrameDecoderTest(unittest.TestCase):
+    def test_fragmented_frames(self):
+        data = b"".join(encode_message({"id": i}) for i in range(3))
+        decoder = DHIPFrameDecoder()
+        messages = []
+        for i in range(len(data)):
+            messages.extend(decoder.feed(data[i:i + 1]))
+        self.assertEqual(messages, [{"id": 0}, {"id": 1}, {"id": 2}])
+        self.assertEqual(decoder.frames, 3)
+        self.assertEqual(decoder.resyncs, 0)
+
+    def test_resync_on_garbage(self):
+        decoder = DHIPFrameDecoder()
+        messages = decoder.feed(b"garbage" + encode_message({"id": 1}) + b"more garbage" + encode_message({"id": 2}))
+        self.assertEqual(messages, [{"id": 1}, {"id": 2}])
+        self.assertEqual(decoder.resyncs, 2)
+        self.assertEqual(decoder.dropped_bytes, len(b"garbage") + len(b"more garbage"))
+
+    def test_resync_on_garbage_over_chunks(self):
+        decoder = DHIPFrameDecoder()
+        self.assertEqual(decoder.feed(b"\x00" * 10), [])
+        self.assertEqual(decoder.feed(b"\x00" * 10 + encode_message({"id": 1})), [{"id": 1}])
+        # One run of garbage, however many chunks it is spread over
+        self.assertEqual(decoder.resyncs, 1)
+        self.assertEqual(decoder.dropped_bytes, 20)
+
+    def test_frame_larger_than_buffer(self):
+        decoder = DHIPFrameDecoder(256)
+        header = DHIP_HEADER.pack(DHIP_MAGIC, bytes(8), 1000, 0, 1000, 0)
+        self.assertEqual(decoder.feed(header + encode_message({"id": 1})), [{"id": 1}])
+        self.assertEqual(decoder.resyncs, 1)
+
+    def test_invalid_payload(self):
+        errors = []
+        decoder = DHIPFrameDecoder(on_error=lambda payload, error: errors.append(payload))
+        payload = b"{not json"
+        frame = DHIP_HEADER.pack(DHIP_MAGIC, bytes(8), len(payload), 0, len(payload), 0) + payload
+        self.assertEqual(decoder.feed(frame + encode_message({"id": 1})), [{"id": 1}])
+        self.assertEqual(decoder.parse_failures, 1)
+        self.assertEqual(errors, [payload])
+
+
+class PendingRequestsTest(unittest.TestCase):
+    def test_reap(self):
+        pending = PendingRequests()
+        first = PendingRequest(1, "a", None, deadline=1.0)
+        second = PendingRequest(2, "a", None, deadline=2.0)
+        pending.add(first)
+        pending.add(second)
+        pending.add(PendingRequest(3, "b", None))
+        self.assertEqual(pending.in_flight, 3)
+
+        self.assertEqual(pending.reap(1.5), [first])
+        self.assertEqual(pending.in_flight, 2)
+        self.assertIsNone(pending.get(1))
+        # A request answered in the meantime is skipped
+        pending.pop(2)
+        self.assertEqual(pending.reap(10), [])
+        self.assertEqual(len(pending), 1)
+
+    def test_cancel_method(self):
+        pending = PendingRequests()
+        handler = object()
+        first = PendingRequest(1, "configManager.getConfig", handler)
+        pending.add(first)
+        pending.add(PendingRequest(2, "configManager.getConfig", object()))
+        pending.add(PendingRequest(3, "magicBox.getDeviceType", handler, single_response=False))
+
+        self.assertEqual(pending.cancel_method("configManager.getConfig", handler), [first])
+        self.assertEqual(pending.in_flight, 1)
+        self.assertEqual(len(pending.cancel_method("magicBox.getDeviceType")), 1)
+        self.assertEqual(pending.in_flight, 1)
+        self.assertEqual(pending.cancel_method("unknown"), [])
+        self.assertEqual(list(pending.requests), [2])
+
+
+class MulticallTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.protocol = VTOProtocol("admin", "", clock=lambda: self.now)
+        self.protocol.connection_made()
+        challenge, = self.sent()
+        self.protocol.receive_data(encode_message({"id": challenge["id"], "session": 1, "result": False,
+                                                   "error": {"message": "Component error: login challenge!"},
+                                                   "params": {"random": "1", "realm": "realm"}}))
+        login, = self.sent()
+        self.protocol.receive_data(encode_message({"id": login["id"], "session": 1, "result": True}))
+        self.assertTrue(self.protocol.logged_in)
+
+    def sent(self) -> list:
+        return DHIPFrameDecoder().feed(self.protocol.data_to_send())
+
+    def test_unanswered_multicall(self):
+        with self.protocol.batch(True):
+            self.protocol.request("magicBox.getDeviceType", handler=lambda data: None)
+            self.protocol.request("magicBox.getSoftwareVersion", handler=lambda data: None)
+        multicall, = self.sent()
+        self.assertEqual(multicall["method"], "system.multicall")
+
+        # The calls do not time out before the system.multicall request they are in
+        self.now = self.protocol.request_timeout
+        events = self.protocol.expire()
+        self.assertEqual([type(event) for event in events], [MulticallRejected])
+        self.assertFalse(self.protocol.multicall_supported)
+        calls = self.sent()
+        self.assertEqual([call["method"] for call in calls],
+                         ["magicBox.getDeviceType", "magicBox.getSoftwareVersion"])
+
+        events = self.protocol.receive_data(encode_message({"id": calls[0]["id"], "result": True}))
+        self.assertEqual([type(event) for event in events], [Response])
+        self.now += self.protocol.request_timeout
+        events = self.protocol.expire()
+        self.assertEqual([(type(event), event.request.request_id) for event in events],
+                         [(RequestTimedOut, calls[1]["id"])])
+
+
+if __name__ == "__main__":
+    unittest.main()